@@ -1,31 +1,44 @@
-import requests, csv, dotenv,logging,json,sys
+import csv, dotenv,logging,json,sys,time,os
+import shapely
 from shapely import wkt
+from shapely.geometry import shape
+from Api.HttpSession import GetSession
+
+
+def addAcquisition(acquisitions, timestamp):
+    """Adds a catalog timestamp to the acquisitions of a date, scenes of the same acquisition share the timestamp."""
+    if "T" in timestamp and timestamp not in acquisitions:
+        acquisitions.append(timestamp)
 
 
 class CatalogApiHandler:
-    def __init__(self,ApiToken,TokenApiHandler,dbHandler):
+    def __init__(self,ApiToken,TokenApiHandler,dbHandler,Session=None,Cache=None,RateLimiter=None):
         self.TokenApiHandler = TokenApiHandler
         self.dbhandler = dbHandler
-
-        if ApiToken is None:
-            self.ApiToken = self.TokenApiHandler.GetToken()
-        else:
-            self.ApiToken = ApiToken
-
-    
-    def GetPictureDates(self,Polygon, FieldId,FromDate,ToDate, next = 0):
-        """Gets a list of dates between the from and To date Where the Satalite took a picture based on a polygon"""
-
-        logging.info(f"Calling the Catalog api for catalog data on Feild with id: {FieldId} ...")
-        
-        
-
-        url = "https://sh.dataspace.copernicus.eu/api/v1/catalog/1.0.0/search"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.ApiToken}"
-        }
-        
+        self.Session = Session if Session is not None else GetSession()
+        self.Cache = Cache
+        # Shared scheduler that keeps the requests under the account quota, requests are sent directly without it
+        self.RateLimiter = RateLimiter
+        self.ApiUrl = os.getenv("CopernicusApiUrl", "https://sh.dataspace.copernicus.eu")
+
+        if ApiToken is not None:
+            self.TokenApiHandler.SetToken(ApiToken)
+
+        # Cost of the last catalog search and of all searches made by this handler
+        self.PageCount = 0
+        self.CatalogLatency = 0.0
+        self.TotalPageCount = 0
+        self.TotalCatalogLatency = 0.0
+
+    def IterateCatalogFeatures(self, Polygon, FromDate, ToDate, MaxCloudCover=None, IncludeGeometry=False):
+        """
+        Generator that follows the next token of the Catalog api and yields the features as each page arrives.
+        With MaxCloudCover the api only returns scenes at or below that cloud cover.
+        IncludeGeometry also returns the footprint of every scene.
+        Every page is requested exactly once, a 401 refreshes the token and retries only that page.
+        Searches answered by the cache cost no api calls, complete searches are added to the cache.
+        """
+        url = f"{self.ApiUrl}/api/v1/catalog/1.0.0/search"
         data = {
             "collections": [
                 "sentinel-2-l1c"
@@ -35,119 +48,172 @@ class CatalogApiHandler:
                 "type": "Polygon",
                 "coordinates": Polygon
             },
-            "limit": 100
+            "limit": 100,
+            # Only return the properties that are used, the assets and links make up most of the response
+            "fields": {
+                "include": ["id", "bbox", "properties.datetime", "properties.platform", "properties.eo:cloud_cover"],
+                "exclude": ["assets", "links", "geometry"]
+            }
         }
-        if next != 0:
-            data["next"] = next
-        with requests.post(url, headers=headers, json=data) as response:
-            responseJson = response.json()
-            if response.status_code == 200:
-                Features = responseJson.get("features", [])
-                uniqueDates = set()
-                if len(Features) >= 1:
-                    logging.info(f"Found {len(Features)} number of features")
-                    for Feature in Features:
-                        properties = Feature.get("properties", {})
-                        datetime = properties.get("datetime", "No datetime provided")
-                        Platform = properties.get("platform", "No plateform provided")
-                        CloudCover = properties.get("eo:cloud_cover", "No cloud_cover provided")
-                        logging.debug(f"Found Feature with datetime: {datetime}, Platform: {Platform} and CloudCover: {CloudCover}")
-                        dateOnly = datetime.split("T")[0]
-                        DateMetaData = [FieldId,datetime,dateOnly,Platform,CloudCover]
-                        if dateOnly not in uniqueDates:
-                            uniqueDates.add(dateOnly)
-                            logging.debug(f"Added new date: {dateOnly}")
-                        self.dbhandler.insertBoundingboxMetaData(DateMetaData)
-                        context = responseJson.get("context", [])
-                        next = context.get("next", "No next")
-                        if next != "No next":
-                            logging.debug(f"list has:{len(uniqueDates)} dates in it before next")
-                            uniqueDates.update(self.GetPictureDates(Polygon, FieldId,FromDate,ToDate ,next)) 
-                            logging.debug(f"list has:{len(uniqueDates)} dates in it after next")
-                            
-                        """with open('DateMetaData.csv', 'a', newline='') as csvfile:
-                            writer = csv.writer(csvfile)
-                            writer.writerow(DateMetaData)
-                        """
-                    return uniqueDates
-                else:
-                    logging.warning("No features found on the date")
-                    with open("ResponseCatalog.txt", "a") as f:
-                        f.write("Polygon: ")
-                        json.dump(Polygon, f)
-                        f.write("\n")
-                        json.dump(responseJson, f, indent=4)
-
-                    
-            elif response.status_code == 401:
-                logging.error("Access code has expired or is incorrect.")
-                self.ApiToken = self.TokenApiHandler.GetToken()
-                Data = self.GetPictureDates(Polygon, FieldId,FromDate,ToDate)
-                return Data
+        if IncludeGeometry:
+            data["fields"]["include"].append("geometry")
+            data["fields"]["exclude"].remove("geometry")
+        if MaxCloudCover is not None:
+            data["filter"] = f"eo:cloud_cover <= {MaxCloudCover}"
+            data["filter-lang"] = "cql2-text"
+
+        self.PageCount = 0
+        self.CatalogLatency = 0.0
+
+        # Everything in the search except the interval and the geometry identifies the cached results
+        searchKey = json.dumps({key: value for key, value in data.items() if key not in ("datetime", "intersects")}, sort_keys=True)
+        cachedFeatures = None
+        if self.Cache is not None:
+            cachedFeatures = self.Cache.Get(searchKey, Polygon, FromDate, ToDate)
+        if cachedFeatures is not None:
+            logging.debug(f"Catalog cache answered the search with {len(cachedFeatures)} features")
+            yield from cachedFeatures
+            return
+
+        collectedFeatures = []
+        retriedAuth = False
+        while True:
+            ApiToken = self.TokenApiHandler.GetToken()
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {ApiToken}"
+            }
+            startTime = time.time()
+            if self.RateLimiter is not None:
+                response = self.RateLimiter.Send(self.Session, "POST", url, headers=headers, json=data)
             else:
+                response = self.Session.post(url, headers=headers, json=data)
+            with response:
+                responseJson = response.json()
+            latency = time.time() - startTime
+            self.CatalogLatency += latency
+            self.TotalCatalogLatency += latency
+
+            if response.status_code == 401 and not retriedAuth:
+                logging.error("Access code has expired or is incorrect.")
+                self.TokenApiHandler.RefreshToken(StaleToken=ApiToken)
+                retriedAuth = True
+                continue
+            if response.status_code != 200:
                 description = responseJson.get("description", "No description provided")
                 logging.error(f"Request failed (Status: {response.status_code}) - {description}")
                 raise Exception(f"API request failed with status {response.status_code}: {description}")
 
-    def GetPictureBBoxes(self, Polygon, FieldID, next=0):
-        """Gets a list of unique bounding boxes where the satellite took a picture based on a polygon."""
+            retriedAuth = False
+            self.PageCount += 1
+            self.TotalPageCount += 1
+            Features = responseJson.get("features", [])
+            logging.debug(f"Catalog page {self.PageCount} returned {len(Features)} features in {latency:.2f} secounds")
+            for Feature in Features:
+                collectedFeatures.append(Feature)
+                yield Feature
 
-        logging.info(f"Calling the Catalog API for catalog data on Field with ID: {FieldID}...")
+            next = responseJson.get("context", {}).get("next")
+            if next is None:
+                break
+            data["next"] = next
 
-        url = "https://sh.dataspace.copernicus.eu/api/v1/catalog/1.0.0/search"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.ApiToken}"
-        }
+        if self.Cache is not None:
+            self.Cache.Put(searchKey, Polygon, FromDate, ToDate, collectedFeatures)
 
-        data = {
-            "collections": ["sentinel-2-l1c"],
-            "datetime": f"{self.FromDate}/{self.ToDate}",
-            "intersects": {
-                "type": "Polygon",
-                "coordinates": Polygon
-            },
-            "limit": 100
-        }
+    def GetPictureDates(self,Polygon, FieldId,FromDate,ToDate,MaxCloudCover=None):
+        """
+        Gets the dates between the from and To date Where the Satalite took a picture based on a polygon.
+        Returns a dictionary of date to the sorted acquisition timestamps of that date, iterating it gives the dates.
+        """
 
-        if next != 0:
-            data["next"] = next
+        logging.info(f"Calling the Catalog api for catalog data on Feild with id: {FieldId} ...")
 
-        response = requests.post(url, headers=headers, json=data)
-        responseJson = response.json()
+        uniqueDates = {}
+        MetaDataRows = []
+        for Feature in self.IterateCatalogFeatures(Polygon, FromDate, ToDate, MaxCloudCover):
+            properties = Feature.get("properties", {})
+            datetime = properties.get("datetime", "No datetime provided")
+            Platform = properties.get("platform", "No plateform provided")
+            CloudCover = properties.get("eo:cloud_cover", "No cloud_cover provided")
+            if MaxCloudCover is not None and isinstance(CloudCover, (int, float)) and CloudCover > MaxCloudCover:
+                logging.debug(f"Skipping Feature with datetime: {datetime} and CloudCover: {CloudCover} above {MaxCloudCover}")
+                continue
+            logging.debug(f"Found Feature with datetime: {datetime}, Platform: {Platform} and CloudCover: {CloudCover}")
+            dateOnly = datetime.split("T")[0]
+            MetaDataRows.append([FieldId,datetime,dateOnly,Platform,CloudCover])
+            if dateOnly not in uniqueDates:
+                uniqueDates[dateOnly] = []
+                logging.debug(f"Added new date: {dateOnly}")
+            addAcquisition(uniqueDates[dateOnly], datetime)
+
+        logging.info(f"Catalog search for {FieldId} found {len(MetaDataRows)} features on {self.PageCount} pages in {self.CatalogLatency:.2f} secounds")
+        if not MetaDataRows:
+            logging.warning("No features found on the date")
+            with open("ResponseCatalog.txt", "a") as f:
+                f.write("Polygon: ")
+                json.dump(Polygon, f)
+                f.write("\n")
+            return uniqueDates
+
+        self.dbhandler.insertBoundingboxMetaDataBatch(MetaDataRows)
+        return {date: sorted(acquisitions) for date, acquisitions in uniqueDates.items()}
+
+    def GetFieldPictureDates(self, Polygon, TileId, FieldPolygons, FromDate, ToDate, MaxCloudCover=None):
+        """
+        Searches the catalog once for a whole tile and maps every scene to the fields its footprint intersects.
+        Metadata rows are written for the tile and for every field, the same rows a search per field would write.
+        Returns the dates where at least one field was captured, as a dictionary of date to the sorted acquisition timestamps of that date.
+        """
+        logging.info(f"Calling the Catalog api for catalog data on tile with id: {TileId} covering {len(FieldPolygons)} fields ...")
+
+        fieldIds = list(FieldPolygons.keys())
+        fieldTree = shapely.STRtree(shapely.from_wkt(list(FieldPolygons.values())))
+
+        tileDates = {}
+        MetaDataRows = []
+        featureCount = 0
+        for Feature in self.IterateCatalogFeatures(Polygon, FromDate, ToDate, MaxCloudCover, IncludeGeometry=True):
+            properties = Feature.get("properties", {})
+            datetime = properties.get("datetime", "No datetime provided")
+            Platform = properties.get("platform", "No plateform provided")
+            CloudCover = properties.get("eo:cloud_cover", "No cloud_cover provided")
+            if MaxCloudCover is not None and isinstance(CloudCover, (int, float)) and CloudCover > MaxCloudCover:
+                continue
+            featureCount += 1
+            dateOnly = datetime.split("T")[0]
+
+            # A scene without a footprint is assumed to cover the whole tile
+            if Feature.get("geometry"):
+                capturedFields = fieldTree.query(shape(Feature["geometry"]), predicate="intersects")
+            else:
+                capturedFields = range(len(fieldIds))
+            if len(capturedFields) == 0:
+                continue
 
-        if response.status_code == 200:
-            Features = responseJson.get("features", [])
-            logging.info(f"Found {len(Features)} number of features")
+            addAcquisition(tileDates.setdefault(dateOnly, []), datetime)
+            MetaDataRows.append([TileId,datetime,dateOnly,Platform,CloudCover])
+            for index in capturedFields:
+                MetaDataRows.append([fieldIds[index],datetime,dateOnly,Platform,CloudCover])
 
-            uniqueBBoxes = set()
-            for Feature in Features:
-                bbox = Feature.get("bbox")
-                if bbox:
-                    bbox_tuple = tuple(bbox)
-                    if bbox_tuple not in uniqueBBoxes:
-                        uniqueBBoxes.add(bbox_tuple)
-                        logging.debug(f"Added new bbox: {bbox_tuple}")
-
-            with open("ResponseCatalog.txt", "w") as f:
-                json.dump(responseJson, f, indent=4)
-
-            context = responseJson.get("context", {})
-            next = context.get("next")
-            if next:
-                logging.debug(f"List has {len(uniqueBBoxes)} bboxes before fetching next page")
-                uniqueBBoxes.update(self.GetPictureBBoxes(Polygon, FieldID, next)) 
-                logging.debug(f"List has {len(uniqueBBoxes)} bboxes after fetching next page")
-
-            return uniqueBBoxes
-
-        elif response.status_code == 401:
-            logging.error("Access code has expired or is incorrect.")
-            self.ApiToken = self.TokenApiHandler.GetToken()
-            return self.GetPictureBBoxes(Polygon=Polygon, FieldID=FieldID)
-
-        else:
-            description = responseJson.get("description", "No description provided")
-            logging.error(f"Request failed (Status: {response.status_code}) - {description}")
-            raise Exception(f"API request failed with status {response.status_code}: {description}")
+        logging.info(f"Catalog search for {TileId} found {featureCount} features covering {len(tileDates)} dates on {self.PageCount} pages in {self.CatalogLatency:.2f} secounds")
+        if MetaDataRows:
+            self.dbhandler.insertBoundingboxMetaDataBatch(MetaDataRows)
+        return {date: sorted(acquisitions) for date, acquisitions in tileDates.items()}
+
+    def GetPictureBBoxes(self, Polygon, FieldID, FromDate, ToDate):
+        """Gets a list of unique bounding boxes where the satellite took a picture based on a polygon."""
+
+        logging.info(f"Calling the Catalog API for catalog data on Field with ID: {FieldID}...")
 
+        uniqueBBoxes = set()
+        for Feature in self.IterateCatalogFeatures(Polygon, FromDate, ToDate):
+            bbox = Feature.get("bbox")
+            if bbox:
+                bbox_tuple = tuple(bbox)
+                if bbox_tuple not in uniqueBBoxes:
+                    uniqueBBoxes.add(bbox_tuple)
+                    logging.debug(f"Added new bbox: {bbox_tuple}")
+
+        logging.info(f"Catalog search for {FieldID} found {len(uniqueBBoxes)} bboxes on {self.PageCount} pages in {self.CatalogLatency:.2f} secounds")
+        return uniqueBBoxes
@@ -0,0 +1,116 @@
+import sqlite3
+import hashlib
+import logging
+import json
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def parseCatalogDate(value):
+    """Parses the ISO timestamps used by the Catalog api, e.g. 2024-08-01T10:36:59.024Z"""
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class CatalogCache:
+    def __init__(self, CacheFile="CatalogCache.sqlite", TimeToLive=7 * 24 * 3600, MaxBytes=256 * 1024 * 1024):
+        """
+        On-disk cache of Catalog api search results.
+        :param CacheFile: Path of the sqlite file that holds the cache.
+        :param TimeToLive: Secounds a search result stays valid.
+        :param MaxBytes: Size limit of the stored results, the least recently used are evicted above it.
+        """
+        self.CacheFile = CacheFile
+        self.TimeToLive = TimeToLive
+        self.MaxBytes = MaxBytes
+        self.Hits = 0
+        self.Misses = 0
+
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS CatalogSearch (
+                    SearchId INTEGER PRIMARY KEY AUTOINCREMENT,
+                    Collection TEXT NOT NULL,
+                    GeometryHash TEXT NOT NULL,
+                    FromDate TEXT NOT NULL,
+                    ToDate TEXT NOT NULL,
+                    Features BLOB NOT NULL,
+                    Size INTEGER NOT NULL,
+                    CreatedAt REAL NOT NULL,
+                    LastUsedAt REAL NOT NULL
+                )
+                """)
+            connection.execute("CREATE INDEX IF NOT EXISTS CatalogSearchKey ON CatalogSearch (Collection, GeometryHash)")
+
+    @contextmanager
+    def _connect(self):
+        """Opens a connection for one transaction so several worker processes can share the cache file."""
+        connection = sqlite3.connect(self.CacheFile, timeout=30)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def GeometryHash(Polygon):
+        return hashlib.sha1(json.dumps(Polygon, separators=(",", ":")).encode()).hexdigest()
+
+    def Get(self, Collection, Polygon, FromDate, ToDate):
+        """
+        Returns the cached features for the search, or None on a miss.
+        A cached search over a larger interval answers a sub-interval by filtering its features on their datetime.
+        """
+        fromDate, toDate = parseCatalogDate(FromDate), parseCatalogDate(ToDate)
+        now = time.time()
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT SearchId, FromDate, ToDate, Features FROM CatalogSearch WHERE Collection = ? AND GeometryHash = ? AND CreatedAt > ?",
+                (Collection, self.GeometryHash(Polygon), now - self.TimeToLive)
+            ).fetchall()
+            for SearchId, cachedFrom, cachedTo, Features in rows:
+                if parseCatalogDate(cachedFrom) <= fromDate and toDate <= parseCatalogDate(cachedTo):
+                    connection.execute("UPDATE CatalogSearch SET LastUsedAt = ? WHERE SearchId = ?", (now, SearchId))
+                    self.Hits += 1
+                    features = json.loads(zlib.decompress(Features))
+                    if cachedFrom == FromDate and cachedTo == ToDate:
+                        return features
+                    return [
+                        feature for feature in features
+                        if fromDate <= parseCatalogDate(feature.get("properties", {}).get("datetime", FromDate)) <= toDate
+                    ]
+        self.Misses += 1
+        return None
+
+    def Put(self, Collection, Polygon, FromDate, ToDate, Features):
+        """Stores the complete result of a search and evicts expired and least recently used entries."""
+        blob = zlib.compress(json.dumps(Features, separators=(",", ":")).encode())
+        now = time.time()
+        geometryHash = self.GeometryHash(Polygon)
+        with self._connect() as connection:
+            # A result that covers an existing entry makes it redundant
+            connection.execute(
+                "DELETE FROM CatalogSearch WHERE Collection = ? AND GeometryHash = ? AND FromDate >= ? AND ToDate <= ?",
+                (Collection, geometryHash, FromDate, ToDate)
+            )
+            connection.execute(
+                "INSERT INTO CatalogSearch (Collection, GeometryHash, FromDate, ToDate, Features, Size, CreatedAt, LastUsedAt) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (Collection, geometryHash, FromDate, ToDate, blob, len(blob), now, now)
+            )
+            self._evict(connection, now)
+
+    def _evict(self, connection, now):
+        connection.execute("DELETE FROM CatalogSearch WHERE CreatedAt <= ?", (now - self.TimeToLive,))
+        totalSize = connection.execute("SELECT COALESCE(SUM(Size), 0) FROM CatalogSearch").fetchone()[0]
+        if totalSize <= self.MaxBytes:
+            return
+        evicted = 0
+        for SearchId, Size in connection.execute("SELECT SearchId, Size FROM CatalogSearch ORDER BY LastUsedAt ASC").fetchall():
+            if totalSize <= self.MaxBytes:
+                break
+            connection.execute("DELETE FROM CatalogSearch WHERE SearchId = ?", (SearchId,))
+            totalSize -= Size
+            evicted += 1
+        logging.info(f"Evicted {evicted} catalog searches from the cache to stay below {self.MaxBytes} bytes")
@@ -0,0 +1,45 @@
+import requests
+import threading
+import logging
+import os
+from requests.adapters import HTTPAdapter
+
+_sharedSession = None
+_sharedSessionLock = threading.Lock()
+
+
+def CreateSession(PoolConnections=None, PoolMaxSize=None):
+    """
+    Creates a requests session with a keep-alive connection pool.
+    :param PoolConnections: Number of hosts the session keeps a pool for.
+    :param PoolMaxSize: Maximum number of open connections per host, extra requests wait for a free connection.
+    """
+    if PoolConnections is None:
+        PoolConnections = int(os.getenv("HttpPoolConnections", 4))
+    if PoolMaxSize is None:
+        PoolMaxSize = int(os.getenv("HttpPoolMaxSize", os.getenv("DownloadConcurrency", 8)))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=PoolConnections,
+        pool_maxsize=PoolMaxSize,
+        pool_block=True
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive"
+    })
+    logging.info(f"Created HTTP session with {PoolConnections} host pools and {PoolMaxSize} connections per host")
+    return session
+
+
+def GetSession():
+    """Returns the session shared by all the api handlers in this process, creating it on first use."""
+    global _sharedSession
+    if _sharedSession is None:
+        with _sharedSessionLock:
+            if _sharedSession is None:
+                _sharedSession = CreateSession()
+    return _sharedSession
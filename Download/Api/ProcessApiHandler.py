@@ -1,48 +1,32 @@
-import requests
 import dotenv
 import logging
 import json
 import sys
 import os
+import hashlib
+import threading
+import numpy as np
+import rasterio
+from rasterio.warp import transform_bounds
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+from Api.HttpSession import GetSession
+from Gis.CogConverter import ConvertToCog
+from Api.RateLimiter import EstimateProcessingUnits
+from Gis.OutputSize import OutputSize, MAX_OUTPUT_PIXELS
+from Database.RasterStore import GeometryHash
 
-class ProcessApiHandler:
-    def __init__(self, ApiToken,TokenApiHandler, SQLHandler):
-        self.TokenApiHandler = TokenApiHandler
-        self.SQLHandler = SQLHandler
-
-        if ApiToken is None:
-            self.ApiToken = self.TokenApiHandler.GetToken()
-        else:
-            self.ApiToken = ApiToken
-
-    def getSurroundingDates(self, date):
-        """
-        Takes a date string in 'yyyy-mm-dd' format and returns two timestamps:
-        - One day before at 00:00:00 UTC.
-        - One day after at 23:59:59 UTC.
-        """
-        dateObj = datetime.strptime(date, "%Y-%m-%d")
-        
-        dateBefore = (dateObj - timedelta(days=1)).strftime("%Y-%m-%dT00:00:00Z")
-        dateAfter = (dateObj + timedelta(days=1)).strftime("%Y-%m-%dT23:59:59Z")
-        
-        return dateBefore, dateAfter
+# Little and big endian TIFF and BigTIFF headers
+TIFF_SIGNATURES = (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+")
 
-    def processDateIntoImages(self,Date,polygon,FieldId,resolution,WorkerName):
-        """
-        Takes a date and polygon and inserts the data from the picture of the date and polygon into the database
-        """
-        logging.info(f"Get picture from satalite on the date of: {Date} with resolution: {resolution}")
-        dateBefore, dateAfter = self.getSurroundingDates(Date)
-        logging.debug(f"converted the date into before date: {dateBefore} and After date: {dateAfter} ")
+# NDVI in the Ndvi band set is returned as INT16 NDVI times this scale
+NDVI_SCALE = 10000
 
-        url = "https://sh.dataspace.copernicus.eu/api/v1/process"
-        headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {self.ApiToken}"
-        }
-        evalscript = """
+# Evalscript of every band set.
+# Raw returns B04, B08 and dataMask as UINT16, Ndvi returns the scaled NDVI and dataMask as INT16, a third less data
+# that compresses to about half since the mask band is almost constant
+EVALSCRIPTS = {
+    "Raw": """
                 function setup() {
                 return {
                     input: [
@@ -66,7 +50,157 @@ class ProcessApiHandler:
                     sample.dataMask,
                 ]
                 }
+        """,
+    "Ndvi": f"""
+                function setup() {{
+                return {{
+                    input: [
+                    {{
+                        bands: ["B04", "B08","dataMask"],
+                        units: "REFLECTANCE",
+                    }},
+                    ],
+                    output: {{
+                    id: "default",
+                    bands: 2,
+                    sampleType: SampleType.INT16,
+                    }},
+                }}
+                }}
+
+                function evaluatePixel(sample) {{
+                let sum = sample.B08 + sample.B04;
+                if (sample.dataMask == 0 || sum == 0) {{
+                    return [0, 0];
+                }}
+                return [
+                    Math.round((sample.B08 - sample.B04) / sum * {NDVI_SCALE}),
+                    1,
+                ]
+                }}
+        """,
+}
+
+# Bands returned by the evalscript of every band set, part of the raster store key
+BAND_SETS = {
+    "Raw": "B04,B08,dataMask",
+    "Ndvi": "NDVI,dataMask",
+}
+
+class ProcessApiHandler:
+    def __init__(self, ApiToken,TokenApiHandler, SQLHandler, Session=None, Manifest=None, Compression=None, RateLimiter=None, Store=None):
+        self.TokenApiHandler = TokenApiHandler
+        self.SQLHandler = SQLHandler
+        self.Session = Session if Session is not None else GetSession()
+        self.Manifest = Manifest
+        # Shared scheduler that keeps the requests and processing units under the account quota
+        self.RateLimiter = RateLimiter
+        # Shared raster store, without it the images are saved in a folder per worker and field
+        self.Store = Store
+        self.storeKeyLocks = {}
+        self.storeKeyLocksGuard = threading.Lock()
+        # The Process API only returns plain GeoTIFFs, with a compression set they are rewritten as COGs
+        self.Compression = Compression
+        self.ApiUrl = os.getenv("CopernicusApiUrl", "https://sh.dataspace.copernicus.eu")
+        # Cap of the width and height when the resolution is a ground sampling distance like 10m
+        self.MaxOutputPixels = int(os.getenv("MaxOutputPixels", MAX_OUTPUT_PIXELS))
+        # Images with a lower fraction of valid pixels are dropped, images without any valid pixel always are
+        self.MinValidFraction = float(os.getenv("MinValidFraction", 0.0))
+        self.EmptyCount = 0
+        self.countLock = threading.Lock()
+
+        if ApiToken is not None:
+            self.TokenApiHandler.SetToken(ApiToken)
+
+    def getAcquisitionWindow(self, date, Acquisitions=None):
+        """
+        Takes a date string in 'yyyy-mm-dd' format and the acquisition timestamps the catalog found on it and returns two timestamps:
+        - One secound before the first acquisition.
+        - One secound after the last acquisition.
+        Without acquisitions the window is the whole date, 00:00:00 to 23:59:59 UTC.
         """
+        if not Acquisitions:
+            dateObj = datetime.strptime(date, "%Y-%m-%d")
+            return dateObj.strftime("%Y-%m-%dT00:00:00Z"), dateObj.strftime("%Y-%m-%dT23:59:59Z")
+
+        acquisitionTimes = [datetime.fromisoformat(acquisition.replace("Z", "+00:00")) for acquisition in Acquisitions]
+        dateBefore = (min(acquisitionTimes) - timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        dateAfter = (max(acquisitionTimes) + timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return dateBefore, dateAfter
+
+    def manifestResolution(self, resolution, BandSet):
+        """Resolution the manifest records a download under, other band sets than Raw are recorded apart."""
+        return resolution if BandSet == "Raw" else f"{resolution}_{BandSet}"
+
+    def processDateIntoImages(self,Date,polygon,FieldId,resolution,WorkerName,Acquisitions=None,BandSet="Raw"):
+        """
+        Takes a date and polygon and inserts the data from the picture of the date and polygon into the database
+        Acquisitions are the catalog timestamps of the date, the request only covers those scenes.
+        BandSet is Raw for the Red, NIR and mask bands or Ndvi for the NDVI and mask bands.
+        Returns the number of bytes saved, or None when the image was already downloaded
+        """
+        # Completion is checked against the polygon as well, a field or box can keep its id while its polygon changes
+        geometryHash = GeometryHash(polygon)
+        if self.Manifest is not None and self.Manifest.IsComplete(FieldId, Date, self.manifestResolution(resolution, BandSet), geometryHash):
+            logging.info(f"Picture for {FieldId} on the date of: {Date} with resolution: {resolution} is already downloaded, skipping...")
+            return None
+
+        if self.Store is None:
+            return self.requestImage(Date, polygon, FieldId, resolution, WorkerName, Acquisitions=Acquisitions, BandSet=BandSet, geometryHash=geometryHash)
+
+        StoreKey = self.Store.Key(polygon, Date, resolution, BAND_SETS[BandSet])
+        # Threads asking for the same raster wait for the first one instead of downloading it again
+        with self.storeKeyLock(StoreKey):
+            emptyFraction = self.Manifest.FindEmpty(StoreKey) if self.Manifest is not None else None
+            if emptyFraction is not None:
+                self.Manifest.MarkEmpty(FieldId, Date, self.manifestResolution(resolution, BandSet), emptyFraction, StoreKey=StoreKey, GeometryHash=geometryHash)
+                logging.info(f"Picture for {FieldId} on the date of: {Date} with resolution: {resolution} is known to be empty, skipping...")
+                return None
+            stored = self.Manifest.FindStored(StoreKey) if self.Manifest is not None else None
+            if stored is not None:
+                # Another field, box or worker already downloaded this exact raster
+                StoredPath, StoredSize, StoredChecksum = stored
+                self.Manifest.MarkComplete(FieldId, Date, self.manifestResolution(resolution, BandSet), StoredPath, StoredSize, StoredChecksum, StoreKey, GeometryHash=geometryHash)
+                logging.info(f"Picture for {FieldId} on the date of: {Date} with resolution: {resolution} is already in the raster store as {StoredPath}, skipping...")
+                return None
+            return self.requestImage(Date, polygon, FieldId, resolution, WorkerName, StoreKey, Acquisitions, BandSet, geometryHash)
+
+    @contextmanager
+    def storeKeyLock(self, StoreKey):
+        """Lock held while a raster store key is downloaded."""
+        with self.storeKeyLocksGuard:
+            lock, users = self.storeKeyLocks.get(StoreKey, (threading.RLock(), 0))
+            self.storeKeyLocks[StoreKey] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self.storeKeyLocksGuard:
+                lock, users = self.storeKeyLocks[StoreKey]
+                if users == 1:
+                    del self.storeKeyLocks[StoreKey]
+                else:
+                    self.storeKeyLocks[StoreKey] = (lock, users - 1)
+
+    def requestImage(self, Date, polygon, FieldId, resolution, WorkerName, StoreKey=None, Acquisitions=None, BandSet="Raw", geometryHash=None, retriedAuth=False):
+        """
+        Requests the image from the Process API and saves it, in the raster store when StoreKey is given.
+        geometryHash is the hash of the polygon the manifest records the download for.
+        A 401 refreshes the token and retries once, retriedAuth is set on that retry.
+        """
+        width, height = OutputSize(polygon, resolution, self.MaxOutputPixels)
+        logging.info(f"Get picture from satalite on the date of: {Date} with resolution: {resolution} as {width}x{height} pixels")
+        dateBefore, dateAfter = self.getAcquisitionWindow(Date, Acquisitions)
+        logging.debug(f"converted the date into before date: {dateBefore} and After date: {dateAfter} ")
+
+        url = f"{self.ApiUrl}/api/v1/process"
+        ApiToken = self.TokenApiHandler.GetToken()
+        headers = {
+        "Content-Type": "application/json",
+        "Accept": "image/tiff",
+        "Authorization": f"Bearer {ApiToken}"
+        }
+        evalscript = EVALSCRIPTS[BandSet]
         data = {
         "input": {
             "bounds": {
@@ -81,15 +215,17 @@ class ProcessApiHandler:
                 "timeRange": {
                     "from": dateBefore,
                     "to": dateAfter
-                    }
+                    },
+                # Where scenes of the acquisition overlap the newest one is used
+                "mosaickingOrder": "mostRecent"
                 },
                 "type": "sentinel-2-l1c"
             }
             ]
         },
         "output": {
-            "width": resolution,
-            "height": resolution,
+            "width": width,
+            "height": height,
             "responses": [
             {
                 "identifier": "default",
@@ -102,27 +238,128 @@ class ProcessApiHandler:
         "evalscript": evalscript
         }
 
-     
-        with requests.post(url, headers=headers, json=data) as response:
+        if self.RateLimiter is not None:
+            response = self.RateLimiter.Send(
+                self.Session, "POST", url,
+                Units=EstimateProcessingUnits(width, height, bands=len(BAND_SETS[BandSet].split(","))),
+                headers=headers, json=data, stream=True
+            )
+        else:
+            response = self.Session.post(url, headers=headers, json=data, stream=True)
+        with response:
             StatusCode = response.status_code
             if StatusCode == 200:
-                folderName = f"Pictures/{WorkerName}/FieldId{FieldId}"  
+                if self.Store is not None:
+                    image_path = self.Store.PathFor(StoreKey, Date)
+                    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+                else:
+                    folderName = f"Pictures/{WorkerName}/FieldId{FieldId}"  
 
-                os.makedirs(folderName, exist_ok=True)
-                image_path = os.path.join(folderName, f"{Date}.tiff")
+                    os.makedirs(folderName, exist_ok=True)
+                    image_path = os.path.join(folderName, f"{Date}.tiff" if BandSet == "Raw" else f"{Date}_{BandSet}.tiff")
                 try:
-                    with open(image_path, "wb") as f: 
-                        f.write(response.content)
-                    logging.info(f"Image successfully saved as {image_path}")
-                except Exception as e:
+                    ImageSize, Checksum, image_path, Info = self.streamResponseToFile(response, image_path)
+                except OSError as e:
+                    # Streaming, raster and store errors are OSErrors too, the fetch engine records the request as failed
                     logging.error(f"Failed to save image: {e}")
+                    raise
+                ValidFraction = Info["ValidFraction"]
+                if image_path is None:
+                    logging.info(f"Picture for {FieldId} on the date of: {Date} has {ValidFraction:.1%} valid pixels, it is recorded as empty")
+                    with self.countLock:
+                        self.EmptyCount += 1
+                    if self.Manifest is not None:
+                        self.Manifest.MarkEmpty(FieldId, Date, self.manifestResolution(resolution, BandSet), ValidFraction, Checksum, StoreKey, geometryHash)
+                    return ImageSize
+                logging.info(f"Image successfully saved as {image_path}")
+                if self.Manifest is not None:
+                    self.Manifest.RecordRaster(image_path, Info, BandSet)
+                    self.Manifest.MarkComplete(FieldId, Date, self.manifestResolution(resolution, BandSet), image_path, os.path.getsize(image_path), Checksum, StoreKey, ValidFraction, geometryHash)
+                return ImageSize
             
 
             else:
                 logging.error(f"Request failed (Status: {response.status_code}) - (Respone:{response.text})")
-                if StatusCode == 401:
-                    self.ApiToken = self.TokenApiHandler.GetToken()
-                    self.processDateIntoImages(Date,polygon, FieldId,resolution,WorkerName)
+                if StatusCode == 401 and not retriedAuth:
+                    self.TokenApiHandler.RefreshToken(StaleToken=ApiToken)
+                    return self.requestImage(Date, polygon, FieldId, resolution, WorkerName, StoreKey, Acquisitions, BandSet, geometryHash, retriedAuth=True)
                 else:
                     raise Exception(f"API request failed with status {response.status_code}")
 
+    def streamResponseToFile(self, response, image_path, chunk_size=1024 * 1024):
+        """
+        Streams the response body to a temporary file in chunks and renames it into place once it is verified,
+        so memory use does not depend on the image size and an interrupted download never leaves a partial image.
+        With the raster store, a body with the same checksum as a stored raster is not stored again.
+        An image with fewer valid pixels than MinValidFraction is not stored at all.
+        Returns the size and the sha256 checksum of the downloaded body, the path the raster is stored at, or None when it was empty,
+        and the raster info of the image.
+        """
+        # Unique temporary names, two threads or workers can download the same raster store path at once
+        temp_suffix = f"{os.getpid()}.{threading.get_ident()}"
+        temp_path = f"{image_path}.{temp_suffix}.part"
+        cog_path = f"{image_path}.{temp_suffix}.cog.part"
+        checksum = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    checksum.update(chunk)
+                    size += len(chunk)
+
+            # Content-Length is the encoded size, so it can only be compared when the body was sent unencoded
+            expected_size = response.headers.get("Content-Length")
+            if expected_size is not None and "Content-Encoding" not in response.headers and int(expected_size) != size:
+                raise Exception(f"Image is truncated, got {size} of {expected_size} bytes")
+            with open(temp_path, "rb") as f:
+                if f.read(4) not in TIFF_SIGNATURES:
+                    raise Exception("Response is not a TIFF image")
+            Info = self.rasterInfo(temp_path)
+            if Info["ValidFraction"] == 0 or Info["ValidFraction"] < self.MinValidFraction:
+                os.remove(temp_path)
+                return size, checksum.hexdigest(), None, Info
+            if self.Store is not None and self.Manifest is not None:
+                # The same scene can be returned for several dates or keys, it is only kept once
+                duplicate = self.Manifest.FindByChecksum(checksum.hexdigest())
+                if duplicate is not None:
+                    logging.info(f"Downloaded image is identical to {duplicate[0]}, using the stored raster")
+                    os.remove(temp_path)
+                    return size, checksum.hexdigest(), duplicate[0], Info
+            if self.Compression is not None:
+                ConvertToCog(temp_path, cog_path, Compression=self.Compression)
+                os.remove(temp_path)
+                temp_path = cog_path
+            if self.Store is not None:
+                self.Store.Commit(temp_path, image_path)
+            else:
+                os.replace(temp_path, image_path)
+        except BaseException:
+            for path in (temp_path, cog_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        return size, checksum.hexdigest(), image_path, Info
+
+    def rasterInfo(self, image_path):
+        """
+        Reads the footprint of an image for the raster catalog, its bounds in EPSG:4326, crs, pixel size and size,
+        and the fraction of the pixels that the dataMask band, the last band of every band set, marks as valid.
+        """
+        with rasterio.open(image_path) as src:
+            dataMask = src.read(src.count)
+            # The Process API answers in the crs of the request bounds, EPSG:4326, when the file does not say otherwise
+            crs = src.crs if src.crs is not None else "EPSG:4326"
+            MinLon, MinLat, MaxLon, MaxLat = transform_bounds(crs, "EPSG:4326", *src.bounds)
+            return {
+                "MinLon": MinLon,
+                "MinLat": MinLat,
+                "MaxLon": MaxLon,
+                "MaxLat": MaxLat,
+                "Crs": src.crs.to_string() if src.crs is not None else crs,
+                "PixelSizeX": src.res[0],
+                "PixelSizeY": src.res[1],
+                "Width": src.width,
+                "Height": src.height,
+                "ValidFraction": np.count_nonzero(dataMask) / dataMask.size if dataMask.size else 0.0,
+            }
@@ -0,0 +1,95 @@
+import concurrent.futures
+import threading
+import logging
+import time
+
+
+class ProcessFetchEngine:
+    def __init__(self, ProcessApiHandler, Concurrency=8):
+        """
+        Runs Process API requests concurrently on a bounded thread pool.
+        :param ProcessApiHandler: The handler used to fetch and save each image.
+        :param Concurrency: Maximum number of requests in flight at the same time.
+        """
+        self.ProcessApiHandler = ProcessApiHandler
+        self.Concurrency = max(1, int(Concurrency))
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.Concurrency,
+            thread_name_prefix="ProcessFetch"
+        )
+        # Caps how many requests can be queued so the catalog loop does not run far ahead of the downloads
+        self.slots = threading.BoundedSemaphore(self.Concurrency * 2)
+        self.lock = threading.Lock()
+        self.futures = []
+
+        self.RequestCount = 0
+        self.FailedCount = 0
+        self.SkippedCount = 0
+        self.BytesDownloaded = 0
+        self.startTime = None
+
+    def Submit(self, Date, Polygon, FieldId, resolution, WorkerName, Acquisitions=None, BandSet="Raw"):
+        """Queues one (polygon, date) request, Acquisitions are the catalog timestamps of the date. Blocks while the queue is full."""
+        if self.startTime is None:
+            self.startTime = time.time()
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._fetch, Date, Polygon, FieldId, resolution, WorkerName, Acquisitions, BandSet)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def _fetch(self, Date, Polygon, FieldId, resolution, WorkerName, Acquisitions=None, BandSet="Raw"):
+        """Fetches a single image. Errors are logged and counted so one failed request does not stop the others."""
+        try:
+            ImageSize = self.ProcessApiHandler.processDateIntoImages(Date, Polygon, FieldId, resolution, WorkerName, Acquisitions, BandSet)
+        except Exception as e:
+            logging.error(f"Error processing date {Date} for polygon with id {FieldId}: {e}")
+            with self.lock:
+                self.RequestCount += 1
+                self.FailedCount += 1
+            return False
+
+        with self.lock:
+            if ImageSize is None:
+                self.SkippedCount += 1
+            else:
+                self.RequestCount += 1
+                self.BytesDownloaded += ImageSize
+        return True
+
+    def Wait(self):
+        """Waits for every queued request to finish and logs the throughput."""
+        concurrent.futures.wait(self.futures)
+        self.futures = []
+        return self.LogThroughput()
+
+    def LogThroughput(self):
+        """Logs and returns the request and byte throughput since the first submitted request."""
+        with self.lock:
+            RequestCount = self.RequestCount
+            FailedCount = self.FailedCount
+            SkippedCount = self.SkippedCount
+            BytesDownloaded = self.BytesDownloaded
+        elapsed = time.time() - self.startTime if self.startTime is not None else 0.0
+        RequestsPerSecond = RequestCount / elapsed if elapsed > 0 else 0.0
+        MegabytesPerSecond = BytesDownloaded / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+        logging.info(
+            f"Process API throughput: {RequestCount} requests ({FailedCount} failed, {SkippedCount} already downloaded) in {elapsed:.1f} secounds, "
+            f"{RequestsPerSecond:.2f} requests/s, {MegabytesPerSecond:.2f} MB/s with concurrency {self.Concurrency}"
+        )
+        return {
+            "Requests": RequestCount,
+            "Failed": FailedCount,
+            "Skipped": SkippedCount,
+            "Bytes": BytesDownloaded,
+            "Seconds": elapsed,
+            "RequestsPerSecond": RequestsPerSecond,
+            "MegabytesPerSecond": MegabytesPerSecond,
+        }
+
+    def Shutdown(self):
+        self.executor.shutdown(wait=True)
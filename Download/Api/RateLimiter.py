@@ -0,0 +1,233 @@
+import email.utils
+import threading
+import logging
+import random
+import fcntl
+import json
+import time
+import os
+import requests
+
+# Processing units are counted per 512x512 pixels with 3 input bands and 16 bit output, and never less than this per request
+MIN_PROCESSING_UNITS = 0.01
+
+
+def EstimateProcessingUnits(width, height, bands=3, sampleType="UINT16", dataFrames=1):
+    """Processing units a Process API request is expected to cost, following the Sentinel Hub pricing rules."""
+    units = (int(width) * int(height) / (512 * 512)) * (bands / 3) * dataFrames
+    if sampleType.upper() == "FLOAT32":
+        units *= 2
+    return max(MIN_PROCESSING_UNITS, units)
+
+
+def parseRetryAfter(value, default):
+    """Returns the secounds to wait from a Retry-After header, which is either secounds or an HTTP date."""
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimiter:
+    def __init__(self, RequestsPerMinute=300, ProcessingUnitsPerMinute=300, StateFile=None, Headroom=0.95,
+                 MaxRetries=5, BaseBackoff=1.0, MaxBackoff=60.0):
+        """
+        Token bucket scheduler for the requests and processing units of the Copernicus account.
+        With a StateFile the buckets are shared by every worker process on the host through a file lock.
+        :param RequestsPerMinute: Request quota of the account.
+        :param ProcessingUnitsPerMinute: Processing unit quota of the account.
+        :param StateFile: Optional path of the JSON file holding the shared bucket state.
+        :param Headroom: Fraction of the quotas that is used, so the account stays just under them.
+        :param MaxRetries: Retries of a request answered with 429, 5xx or a connection error.
+        :param BaseBackoff: Secounds of the first backoff, it doubles with every retry.
+        :param MaxBackoff: Maximum secounds of a backoff.
+        """
+        self.RequestRate = RequestsPerMinute * Headroom / 60
+        self.UnitRate = ProcessingUnitsPerMinute * Headroom / 60
+        self.StateFile = StateFile
+        self.MaxRetries = MaxRetries
+        self.BaseBackoff = BaseBackoff
+        self.MaxBackoff = MaxBackoff
+
+        # The buckets start full but hold at most a few secounds of quota, so a burst can not overshoot the minute
+        self.RequestCapacity = max(1.0, self.RequestRate * 5)
+        self.UnitCapacity = max(MIN_PROCESSING_UNITS, self.UnitRate * 5)
+        self.lock = threading.Lock()
+        self.state = self._newState()
+
+        self.RateLimitedCount = 0
+        self.RetryCount = 0
+        self.UnitEstimate = None
+
+    def _newState(self):
+        return {
+            "requests": self.RequestCapacity,
+            "units": self.UnitCapacity,
+            "updated": time.time(),
+            "blocked_until": 0.0,
+            # Running average of the units spent per request, and of the spent units over the estimated units
+            "unit_estimate": None,
+            "unit_ratio": None
+        }
+
+    def _withState(self, update):
+        """Runs update on the bucket state while holding the thread lock and, when shared, the file lock."""
+        with self.lock:
+            if self.StateFile is None:
+                return update(self.state)
+
+            with open(f"{self.StateFile}.lock", "w") as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                try:
+                    state = self._readStateFile()
+                    result = update(state)
+                    self._writeStateFile(state)
+                    return result
+                finally:
+                    fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def _readStateFile(self):
+        try:
+            with open(self.StateFile, "r") as f:
+                state = json.load(f)
+            return {**self._newState(), **state}
+        except (OSError, ValueError):
+            return self._newState()
+
+    def _writeStateFile(self, state):
+        tempFile = f"{self.StateFile}.tmp"
+        with open(tempFile, "w") as f:
+            json.dump(state, f)
+        os.replace(tempFile, self.StateFile)
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state["updated"])
+        state["requests"] = min(self.RequestCapacity, state["requests"] + elapsed * self.RequestRate)
+        state["units"] = min(self.UnitCapacity, state["units"] + elapsed * self.UnitRate)
+        state["updated"] = now
+
+    def Acquire(self, Units=0.0):
+        """
+        Blocks until one request and the processing units can be spent without going over the quotas.
+        Returns the processing units that were reserved.
+        """
+        while True:
+            def take(state):
+                now = time.time()
+                self._refill(state, now)
+                if state["blocked_until"] > now:
+                    return state["blocked_until"] - now, None
+                units = Units
+                if units and state["unit_ratio"] is not None:
+                    units *= state["unit_ratio"]
+                # Never wait for more units than the bucket can hold
+                units = min(units, self.UnitCapacity)
+                if state["requests"] >= 1 and state["units"] >= units:
+                    state["requests"] -= 1
+                    state["units"] -= units
+                    return 0.0, units
+                requestWait = (1 - state["requests"]) / self.RequestRate if state["requests"] < 1 else 0.0
+                unitWait = (units - state["units"]) / self.UnitRate if state["units"] < units else 0.0
+                return max(requestWait, unitWait), None
+
+            wait, reserved = self._withState(take)
+            if reserved is not None:
+                return reserved
+            time.sleep(min(wait, self.MaxBackoff) + random.uniform(0, 0.05))
+
+    def Block(self, Secounds):
+        """Pauses every worker sharing the state for the given secounds, used when the API answers 429."""
+        def block(state):
+            state["blocked_until"] = max(state["blocked_until"], time.time() + Secounds)
+            state["requests"] = 0.0
+        self._withState(block)
+
+    def Refund(self, Units):
+        """Returns the processing units reserved for a request that was not processed, so a retry does not pay for it twice."""
+        if not Units:
+            return
+        def refund(state):
+            state["units"] = min(self.UnitCapacity, state["units"] + Units)
+        self._withState(refund)
+
+    def RecordProcessingUnits(self, Reserved, Spent, Estimated):
+        """Settles the difference between the reserved and the spent units and updates the running estimates."""
+        def record(state):
+            state["units"] -= Spent - Reserved
+            ratio = Spent / Estimated if Estimated else 1.0
+            if state["unit_estimate"] is None:
+                state["unit_estimate"], state["unit_ratio"] = Spent, ratio
+            else:
+                state["unit_estimate"] = 0.8 * state["unit_estimate"] + 0.2 * Spent
+                state["unit_ratio"] = 0.8 * state["unit_ratio"] + 0.2 * ratio
+            return state["unit_estimate"]
+        self.UnitEstimate = self._withState(record)
+
+    def Backoff(self, Attempt):
+        """Full jitter exponential backoff in secounds for the given retry attempt."""
+        return random.uniform(0, min(self.MaxBackoff, self.BaseBackoff * 2 ** Attempt))
+
+    def Send(self, Session, Method, Url, Units=0.0, **kwargs):
+        """
+        Sends a request once the quotas allow it.
+        429 responses are retried after their Retry-After, 5xx responses and connection errors after a jittered backoff.
+        Returns the last response, which is not 429 or 5xx unless the retries ran out.
+        The units reserved for a request that is not processed are refunded.
+        :param Units: Expected processing units of the request, 0 for requests that are not charged.
+        """
+        for Attempt in range(self.MaxRetries + 1):
+            Reserved = self.Acquire(Units)
+            try:
+                response = Session.request(Method, Url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.Refund(Reserved)
+                if Attempt == self.MaxRetries:
+                    raise
+                delay = self.Backoff(Attempt)
+                logging.warning(f"Request to {Url} failed with {e}, retrying in {delay:.1f} secounds")
+                self.RetryCount += 1
+                time.sleep(delay)
+                continue
+
+            if response.status_code == 429:
+                delay = parseRetryAfter(response.headers.get("Retry-After"), self.BaseBackoff * 2 ** Attempt)
+                delay += random.uniform(0, self.BaseBackoff)
+                self.RateLimitedCount += 1
+                self.Block(delay)
+            elif response.status_code >= 500:
+                delay = self.Backoff(Attempt)
+            else:
+                Spent = response.headers.get("x-processingunits-spent")
+                if Spent is not None:
+                    try:
+                        self.RecordProcessingUnits(Reserved, float(Spent), Units)
+                    except ValueError:
+                        pass
+                elif Units:
+                    self.RecordProcessingUnits(Reserved, Units, Units)
+                return response
+
+            self.Refund(Reserved)
+            if Attempt == self.MaxRetries:
+                return response
+            logging.warning(f"Request to {Url} answered {response.status_code}, retrying in {delay:.1f} secounds")
+            self.RetryCount += 1
+            response.close()
+            time.sleep(delay)
+
+
+def CreateRateLimiter():
+    """Creates the rate limiter configured in the environment."""
+    return RateLimiter(
+        RequestsPerMinute=float(os.getenv("CopernicusRequestsPerMinute", 300)),
+        ProcessingUnitsPerMinute=float(os.getenv("CopernicusProcessingUnitsPerMinute", 300)),
+        StateFile=os.getenv("RateLimitStateFile", "RateLimit.json") or None,
+        Headroom=float(os.getenv("RateLimitHeadroom", 0.95)),
+        MaxRetries=int(os.getenv("RateLimitMaxRetries", 5))
+    )
@@ -1,31 +1,108 @@
-import requests
-import dotenv
 import logging
 import json
-import sys
+import time
+import threading
+import fcntl
+import os
+from Api.HttpSession import GetSession
 
 
 class TokenApiHandler:
-    def __init__(self, ClientId, ClientSecret):
+    def __init__(self, ClientId, ClientSecret, Session=None, CacheFile=None, RefreshMargin=60):
+        """
+        Keeps the API token in memory and refreshes it shortly before it expires.
+        :param ClientId: Client id of the Copernicus OAuth client.
+        :param ClientSecret: Client secret of the Copernicus OAuth client.
+        :param Session: HTTP session used for the token requests.
+        :param CacheFile: Optional path of a file used to share the token between worker processes.
+        :param RefreshMargin: Secounds before the expiry where the token is refreshed.
+        """
         self.ClientId = ClientId
         self.ClientSecret = ClientSecret
+        self.Session = Session if Session is not None else GetSession()
+        self.CacheFile = CacheFile
+        self.RefreshMargin = RefreshMargin
+        self.IdentityUrl = os.getenv("CopernicusIdentityUrl", "https://identity.dataspace.copernicus.eu")
+
+        self.token = None
+        self.expiresAt = 0.0
+        self.refreshLock = threading.Lock()
+
+    def SetToken(self, token, expiresAt=None):
+        """Seeds the handler with a known token. Without an expiry it is used until the API rejects it."""
+        with self.refreshLock:
+            self.token = token
+            self.expiresAt = expiresAt if expiresAt is not None else float("inf")
+
+    def _isValid(self, token, expiresAt):
+        return token is not None and time.time() < expiresAt - self.RefreshMargin
 
     def GetToken(self):
+        """Returns a valid token, only calling the API when the current one is about to expire."""
+        token, expiresAt = self.token, self.expiresAt
+        if self._isValid(token, expiresAt):
+            return token
+        return self.RefreshToken(StaleToken=token)
+
+    def RefreshToken(self, StaleToken=None):
+        """
+        Replaces the token after it has expired or been rejected.
+        Concurrent callers wait for the same refresh instead of each requesting a new token.
+        """
+        with self.refreshLock:
+            # Another thread may already have replaced the stale token while this one waited
+            if self.token != StaleToken and self._isValid(self.token, self.expiresAt):
+                return self.token
+
+            if self.CacheFile is None:
+                self.token, self.expiresAt = self._requestToken()
+                return self.token
+
+            with open(f"{self.CacheFile}.lock", "w") as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                try:
+                    cachedToken, cachedExpiresAt = self._readCacheFile()
+                    if cachedToken != StaleToken and self._isValid(cachedToken, cachedExpiresAt):
+                        logging.info("Using the API Token refreshed by another worker.")
+                        self.token, self.expiresAt = cachedToken, cachedExpiresAt
+                    else:
+                        self.token, self.expiresAt = self._requestToken()
+                        self._writeCacheFile(self.token, self.expiresAt)
+                finally:
+                    fcntl.flock(lockFile, fcntl.LOCK_UN)
+            return self.token
+
+    def _readCacheFile(self):
+        try:
+            with open(self.CacheFile, "r") as f:
+                cache = json.load(f)
+            return cache["access_token"], float(cache["expires_at"])
+        except (OSError, ValueError, KeyError):
+            return None, 0.0
+
+    def _writeCacheFile(self, token, expiresAt):
+        tempFile = f"{self.CacheFile}.tmp"
+        with open(tempFile, "w") as f:
+            json.dump({"access_token": token, "expires_at": expiresAt}, f)
+        os.chmod(tempFile, 0o600)
+        os.replace(tempFile, self.CacheFile)
+
+    def _requestToken(self):
             """Gets an Access Token from the API based on the client credentials"""
 
             logging.info("Attempting to get an API Token...")
-            
-            dotenvFile = dotenv.find_dotenv()
-            AuthServerUrl = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
+
+            AuthServerUrl = f"{self.IdentityUrl}/auth/realms/CDSE/protocol/openid-connect/token"
             TokenRequestPayload = {"grant_type": "client_credentials"}
-            with requests.post(
+            requestedAt = time.time()
+            with self.Session.post(
                 AuthServerUrl,
                 data=TokenRequestPayload,
                 verify=False,
                 allow_redirects=False,
                 auth=(self.ClientId, self.ClientSecret)
             ) as tokenResponse :
-                
+
                 if tokenResponse.status_code != 200:
                     logging.error(f"Failed to obtain token. Status code: {tokenResponse.status_code}")
                     logging.error(f"Response: {tokenResponse.text}")
@@ -33,6 +110,6 @@ class TokenApiHandler:
 
                 tokenjson = tokenResponse.json()
                 token = tokenjson["access_token"]
-                dotenv.set_key(dotenvFile, "APIToken", token)
-                logging.info("Successfully obtained a new token.")
-                return token    
+                expiresAt = requestedAt + float(tokenjson.get("expires_in", 600))
+                logging.info(f"Successfully obtained a new token valid for {expiresAt - requestedAt:.0f} secounds.")
+                return token, expiresAt
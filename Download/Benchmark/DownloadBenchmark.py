@@ -0,0 +1,222 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from Benchmark.MockCopernicusServer import MockCopernicusState, StartMockServer
+
+
+class BenchmarkSQLHandler:
+    """In-memory stand-in for the SQLHandler methods the download process uses, so no MySQL server is needed."""
+
+    def __init__(self, fieldPolygons=None):
+        self.fieldPolygons = fieldPolygons or {}
+        self.metaData = []
+        self.tileCoverage = []
+        self.lock = threading.Lock()
+
+    def getAllFieldPolygons(self):
+        return dict(self.fieldPolygons)
+
+    def insertBoundingboxMetaDataBatch(self, ListOfMetaData, batch_size=1000):
+        with self.lock:
+            self.metaData.extend(ListOfMetaData)
+
+    def insertBoundingboxMetaData(self, ListOfMetaData):
+        self.insertBoundingboxMetaDataBatch(ListOfMetaData)
+
+    def insertFieldTileCoverage(self, tiles):
+        with self.lock:
+            self.tileCoverage.extend(tiles.items())
+
+
+class LatencyRecorder:
+    """
+    Response hook that records the latency of every request sent through the shared session,
+    and the images and bytes the Process API returned, which are all that is known of a run that failed.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.images = 0
+        self.imageBytes = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, response, *args, **kwargs):
+        endpoint = "process" if response.url.endswith("/process") else "catalog" if "/catalog/" in response.url else "token"
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(response.elapsed.total_seconds())
+            self.statuses[response.status_code] = self.statuses.get(response.status_code, 0) + 1
+            if endpoint == "process" and response.status_code == 200:
+                self.images += 1
+                self.imageBytes += int(response.headers.get("Content-Length", 0))
+        return response
+
+    def Percentiles(self, endpoint):
+        latencies = self.latencies.get(endpoint)
+        if not latencies:
+            return None
+        return np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+
+
+def LoadFieldPolygons(path, maxFields):
+    """Loads field polygons in EPSG:4326 from a vector file, or from a folder with one GeoJSON file per field."""
+    import pandas as pd
+    import geopandas as gpd
+
+    if os.path.isdir(path):
+        files = sorted(name for name in os.listdir(path) if name.endswith(".geojson"))[:maxFields]
+        fields = pd.concat([gpd.read_file(os.path.join(path, name)) for name in files], ignore_index=True)
+    else:
+        fields = gpd.read_file(path).head(maxFields)
+    # The field exports are in ETRS89 / UTM 32N but some of them declare EPSG:4326
+    if fields.crs is None or (fields.crs.is_geographic and abs(fields.total_bounds).max() > 180):
+        fields = fields.set_crs("EPSG:25832", allow_override=True)
+    fields = fields.to_crs("EPSG:4326")
+    return {f"Benchmark_{index}": geometry.wkt for index, geometry in zip(fields.index, fields.geometry)}
+
+
+def RunBenchmark(args):
+    """Runs one download against the mock api and returns the fetch stats and the recorded latencies."""
+    state = MockCopernicusState(
+        Latency=args.latency,
+        Jitter=args.jitter,
+        UnauthorizedRate=args.rate_401,
+        RateLimitRate=args.rate_429,
+        ServerErrorRate=args.rate_5xx,
+        MaskedRate=args.rate_masked,
+        Seed=args.seed
+    )
+    server = StartMockServer(state)
+    mockUrl = f"http://127.0.0.1:{server.server_port}"
+    workDir = tempfile.mkdtemp(prefix="DownloadBenchmark")
+
+    # The handlers read their endpoints and settings from the environment when they are created
+    os.environ["CopernicusApiUrl"] = mockUrl
+    os.environ["CopernicusIdentityUrl"] = mockUrl
+    os.environ["DownloadConcurrency"] = str(args.concurrency)
+    os.environ["DownloadManifestFile"] = os.path.join(workDir, "manifest.sqlite")
+    os.environ["DownloadCompression"] = args.compression
+    os.environ["CatalogCacheFile"] = ""
+    os.environ["RasterStoreRoot"] = "Pictures/Benchmark/Store"
+    os.environ["RateLimitStateFile"] = os.path.join(workDir, "RateLimit.json")
+    os.environ["CopernicusRequestsPerMinute"] = str(args.requests_per_minute)
+    os.environ["CopernicusProcessingUnitsPerMinute"] = str(args.units_per_minute)
+    os.environ["MinValidFraction"] = str(args.min_valid_fraction)
+    os.environ.pop("TokenCacheFile", None)
+    os.environ.setdefault("ApiClienId", "benchmark")
+    os.environ.setdefault("ApiClienSecret", "benchmark")
+
+    import DownloadProcess
+    from Api.HttpSession import GetSession
+
+    recorder = LatencyRecorder()
+    GetSession().hooks["response"].append(recorder)
+    DownloadProcess.workername = "Benchmark"
+    shutil.rmtree("Pictures/Benchmark", ignore_errors=True)
+
+    fieldPolygons = {}
+    if args.mode == "Field":
+        fieldPolygons = LoadFieldPolygons(args.fields, args.max_fields)
+
+    startTime = time.time()
+    FetchStats = None
+    Error = None
+    try:
+        FetchStats = DownloadProcess.DownloadProcess(
+            args.from_date,
+            args.to_date,
+            args.mode,
+            args.region,
+            str(args.resolution),
+            args.max_cloud,
+            args.band_set,
+            db_handler=BenchmarkSQLHandler(fieldPolygons)
+        )
+    except Exception as e:
+        # A failed run is still reported, injected errors can fail a catalog search
+        logging.error(f"Download process failed: {e}")
+        Error = e
+    finally:
+        elapsed = time.time() - startTime
+        GetSession().hooks["response"].remove(recorder)
+        server.shutdown()
+        server.server_close()
+        if not args.keep_files:
+            shutil.rmtree("Pictures/Benchmark", ignore_errors=True)
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    return FetchStats, recorder, state, elapsed, Error
+
+
+def PrintReport(FetchStats, recorder, state, elapsed, args, Error=None):
+    print(f"Download benchmark: mode {args.mode}, region {args.region}, resolution {args.resolution}, band set {args.band_set}, concurrency {args.concurrency}, compression {args.compression}")
+    print(f"Mock latency {args.latency * 1000:.0f} ms + up to {args.jitter * 1000:.0f} ms, 401 rate {args.rate_401}, 429 rate {args.rate_429}, 5xx rate {args.rate_5xx}, masked rate {args.rate_masked}")
+    print(f"Total time: {elapsed:.2f} secounds")
+    if Error is not None:
+        print(f"Run FAILED: {Error}")
+        print(
+            f"Process requests before the failure: {len(recorder.latencies.get('process', []))}, "
+            f"{recorder.images} images, {recorder.imageBytes / (1024 * 1024):.2f} MB"
+        )
+    if FetchStats is not None:
+        seconds = FetchStats["Seconds"]
+        print(
+            f"Process requests: {FetchStats['Requests']} ({FetchStats['Failed']} failed, {FetchStats['Skipped']} skipped), "
+            f"{FetchStats['Requests'] / seconds if seconds > 0 else 0.0:.2f} requests/s, "
+            f"{FetchStats['Bytes'] / (1024 * 1024) / seconds if seconds > 0 else 0.0:.2f} MB/s"
+        )
+    for endpoint in ("token", "catalog", "process"):
+        percentiles = recorder.Percentiles(endpoint)
+        if percentiles is not None:
+            p50, p95, p99 = percentiles
+            print(f"{endpoint:>8} latency over {len(recorder.latencies[endpoint])} requests: p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms")
+    print(f"Client status codes: {dict(sorted(recorder.statuses.items()))}")
+    print(f"Quota {args.requests_per_minute:g} requests and {args.units_per_minute:g} processing units per minute")
+    print(f"Mock server counts: {dict(sorted(state.Counts.items()))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the download process against an offline mock of the Copernicus apis. Run from the Download folder with python -m Benchmark.DownloadBenchmark")
+    parser.add_argument("--mode", default="BB", choices=["BB", "Field"])
+    parser.add_argument("--region", default="Fyn", help="Region of the bounding boxes in BB mode")
+    parser.add_argument("--fields", default="../Shapefiles/individualgeoJSON", help="Field polygon file or folder of GeoJSON files used in Field mode")
+    parser.add_argument("--max-fields", type=int, default=500, help="Number of fields used in Field mode")
+    parser.add_argument("--from-date", default="2024-05-01T00:00:00Z")
+    parser.add_argument("--to-date", default="2024-05-31T23:59:59Z")
+    parser.add_argument("--resolution", default="256", help="Pixels, like 256, or meters per pixel, like 10m")
+    parser.add_argument("--max-cloud", type=float, default=None)
+    parser.add_argument("--band-set", default="Raw", choices=["Raw", "Ndvi"])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--compression", default="NONE", help="NONE, DEFLATE, ZSTD or LZW")
+    parser.add_argument("--latency", type=float, default=0.05, help="Base latency of the mock api in secounds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Maximum extra random latency in secounds")
+    parser.add_argument("--rate-401", type=float, default=0.0, help="Fraction of requests answered with 401")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="Fraction of requests answered with 5xx")
+    parser.add_argument("--rate-masked", type=float, default=0.0, help="Fraction of images returned without valid pixels")
+    parser.add_argument("--min-valid-fraction", type=float, default=0.0, help="Images with fewer valid pixels are recorded as empty")
+    parser.add_argument("--requests-per-minute", type=float, default=100000, help="Request quota the rate limiter schedules for")
+    parser.add_argument("--units-per-minute", type=float, default=100000, help="Processing unit quota the rate limiter schedules for")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep-files", action="store_true", help="Keep the downloaded images in Pictures/Benchmark")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s - %(levelname)s - %(message)s")
+
+    FetchStats, recorder, state, elapsed, Error = RunBenchmark(args)
+    PrintReport(FetchStats, recorder, state, elapsed, args, Error)
+    if Error is not None:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
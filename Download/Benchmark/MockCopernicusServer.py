@@ -0,0 +1,314 @@
+import json
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import logging
+import argparse
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def EncodeGeoTiff(bands, bounds):
+    """
+    Encodes a (bands, height, width) UINT16 or INT16 array as an uncompressed, single strip GeoTIFF in EPSG:4326.
+    Written by hand so the mock server does not need GDAL.
+    """
+    count, height, width = bands.shape
+    signed = bands.dtype == np.int16
+    pixels = np.ascontiguousarray(bands.transpose(1, 2, 0), dtype="<i2" if signed else "<u2").tobytes()
+    west, south, east, north = bounds
+
+    # (tag, type, values), types: 3 = SHORT, 4 = LONG, 12 = DOUBLE
+    entries = [
+        (256, 4, [width]),
+        (257, 4, [height]),
+        (258, 3, [16] * count),
+        (259, 3, [1]),
+        (262, 3, [1]),
+        (273, 4, [0]),
+        (277, 3, [count]),
+        (278, 4, [height]),
+        (279, 4, [len(pixels)]),
+        (284, 3, [1]),
+        (338, 3, [0] * (count - 1)),
+        # SampleFormat: 1 = unsigned, 2 = signed integer
+        (339, 3, [2 if signed else 1] * count),
+        (33550, 12, [(east - west) / width, (north - south) / height, 0.0]),
+        (33922, 12, [0.0, 0.0, 0.0, west, north, 0.0]),
+        # GeoKeys: geographic model, pixel is area, WGS 84
+        (34735, 3, [1, 1, 0, 3, 1024, 0, 1, 2, 1025, 0, 1, 1, 2048, 0, 1, 4326]),
+    ]
+    typeFormats = {3: "H", 4: "I", 12: "d"}
+
+    ifdOffset = 8
+    ifdSize = 2 + 12 * len(entries) + 4
+    extraOffset = ifdOffset + ifdSize
+    extraData = b""
+    ifd = struct.pack("<H", len(entries))
+    stripEntryPosition = None
+    for tag, fieldType, values in entries:
+        packed = struct.pack(f"<{len(values)}{typeFormats[fieldType]}", *values)
+        if len(packed) <= 4:
+            if tag == 273:
+                stripEntryPosition = len(ifd) + 8
+            ifd += struct.pack("<HHI", tag, fieldType, len(values)) + packed.ljust(4, b"\x00")
+        else:
+            ifd += struct.pack("<HHII", tag, fieldType, len(values), extraOffset + len(extraData))
+            extraData += packed
+            if len(extraData) % 2:
+                extraData += b"\x00"
+    ifd += struct.pack("<I", 0)
+
+    stripOffset = extraOffset + len(extraData)
+    ifd = ifd[:stripEntryPosition] + struct.pack("<I", stripOffset) + ifd[stripEntryPosition + 4:]
+    return b"II*\x00" + struct.pack("<I", ifdOffset) + ifd + extraData + pixels
+
+
+class MockCopernicusState:
+    def __init__(self, Latency=0.05, Jitter=0.02, UnauthorizedRate=0.0, RateLimitRate=0.0, ServerErrorRate=0.0,
+                 RetryAfter=1, TokenLifetime=600, RevisitDays=2, ScenesPerDate=2, MaskedRate=0.0, Seed=None):
+        """
+        Behaviour of the mock api.
+        :param Latency: Base delay in secounds added to every response.
+        :param Jitter: Maximum random delay added on top of the latency.
+        :param UnauthorizedRate: Fraction of api requests rejected with 401.
+        :param RateLimitRate: Fraction of api requests rejected with 429 and a Retry-After header.
+        :param ServerErrorRate: Fraction of api requests failing with 500, 502 or 503.
+        :param RevisitDays: Days between synthetic acquisitions.
+        :param ScenesPerDate: Catalog features returned for every acquisition date.
+        :param MaskedRate: Fraction of process responses without valid pixels, like a tile edge or a missed orbit.
+        """
+        self.Latency = Latency
+        self.Jitter = Jitter
+        self.UnauthorizedRate = UnauthorizedRate
+        self.RateLimitRate = RateLimitRate
+        self.ServerErrorRate = ServerErrorRate
+        self.RetryAfter = RetryAfter
+        self.TokenLifetime = TokenLifetime
+        self.RevisitDays = RevisitDays
+        self.ScenesPerDate = ScenesPerDate
+        self.MaskedRate = MaskedRate
+        self.random = random.Random(Seed)
+
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.pixelCache = {}
+        self.Counts = {}
+
+    def Count(self, name):
+        with self.lock:
+            self.Counts[name] = self.Counts.get(name, 0) + 1
+
+    def Roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def IssueToken(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.time() + self.TokenLifetime
+        return token
+
+    def IsTokenValid(self, token):
+        with self.lock:
+            return self.tokens.get(token, 0) > time.time()
+
+    def Pixels(self, width, height, day=0):
+        """Synthetic B04, B08 and dataMask bands, generated once per size and acquisition day."""
+        key = (width, height, day)
+        with self.lock:
+            if key not in self.pixelCache:
+                generator = np.random.default_rng([width, height, day])
+                red = generator.integers(300, 2000, size=(height, width), dtype=np.uint16)
+                nir = generator.integers(1500, 5000, size=(height, width), dtype=np.uint16)
+                dataMask = np.ones((height, width), dtype=np.uint16)
+                self.pixelCache[key] = np.stack([red, nir, dataMask])
+            return self.pixelCache[key]
+
+    def NdviPixels(self, width, height, day=0):
+        """NDVI scaled to INT16 and dataMask bands of the same synthetic scene, as the Ndvi evalscript returns them."""
+        red, nir, dataMask = self.Pixels(width, height, day).astype(np.float64)
+        ndvi = np.round((nir - red) / (nir + red) * 10000)
+        return np.stack([ndvi, dataMask]).astype(np.int16)
+
+
+def parseDate(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def polygonBounds(coordinates):
+    points = np.array(coordinates[0], dtype=float)
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+
+class MockCopernicusHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        logging.debug(f"Mock api: {format % args}")
+
+    def sendJson(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def readBody(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        state = self.state
+        body = self.readBody()
+        time.sleep(state.Latency + state.Jitter * state.Roll())
+
+        if self.path.endswith("/protocol/openid-connect/token"):
+            state.Count("token")
+            self.sendJson(200, {"access_token": state.IssueToken(), "expires_in": state.TokenLifetime, "token_type": "Bearer"})
+            return
+
+        token = self.headers.get("Authorization", "").replace("Bearer ", "")
+        roll = state.Roll()
+        if not state.IsTokenValid(token) or roll < state.UnauthorizedRate:
+            state.Count("401")
+            self.sendJson(401, {"description": "Token is expired or invalid"})
+            return
+        roll -= state.UnauthorizedRate
+        if roll < state.RateLimitRate:
+            state.Count("429")
+            self.sendJson(429, {"description": "Too many requests"}, {"Retry-After": str(state.RetryAfter)})
+            return
+        roll -= state.RateLimitRate
+        if roll < state.ServerErrorRate:
+            status = state.random.choice([500, 502, 503])
+            state.Count(str(status))
+            self.sendJson(status, {"description": "Mock server error"})
+            return
+
+        if self.path.endswith("/api/v1/catalog/1.0.0/search"):
+            self.catalogSearch(json.loads(body))
+        elif self.path.endswith("/api/v1/process"):
+            self.process(json.loads(body))
+        else:
+            self.sendJson(404, {"description": f"Unknown endpoint {self.path}"})
+
+    def catalogSearch(self, search):
+        state = self.state
+        state.Count("catalog")
+        fromDate, toDate = (parseDate(value) for value in search["datetime"].split("/"))
+        coordinates = search["intersects"]["coordinates"]
+        west, south, east, north = polygonBounds(coordinates)
+
+        maxCloud = None
+        match = re.search(r"eo:cloud_cover\s*<=\s*([\d.]+)", search.get("filter", ""))
+        if match:
+            maxCloud = float(match.group(1))
+
+        features = []
+        day = datetime(fromDate.year, fromDate.month, fromDate.day, 10, 36, 29, tzinfo=timezone.utc)
+        while day <= toDate:
+            if day >= fromDate and day.toordinal() % state.RevisitDays == 0:
+                for scene in range(state.ScenesPerDate):
+                    acquired = day + timedelta(seconds=3 * scene)
+                    cloudCover = (day.toordinal() * 37 + scene * 11) % 100
+                    if maxCloud is not None and cloudCover > maxCloud:
+                        continue
+                    features.append({
+                        "id": f"S2_MOCK_{acquired:%Y%m%dT%H%M%S}_{scene}",
+                        "bbox": [west - 0.5, south - 0.5, east + 0.5, north + 0.5],
+                        "geometry": {"type": "Polygon", "coordinates": [[
+                            [west - 0.5, south - 0.5], [east + 0.5, south - 0.5], [east + 0.5, north + 0.5], [west - 0.5, north + 0.5], [west - 0.5, south - 0.5]
+                        ]]},
+                        "properties": {
+                            "datetime": acquired.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                            "platform": "sentinel-2a" if scene % 2 == 0 else "sentinel-2b",
+                            "eo:cloud_cover": cloudCover,
+                        },
+                    })
+            day += timedelta(days=1)
+
+        offset = int(search.get("next", 0))
+        limit = int(search.get("limit", 100))
+        page = features[offset:offset + limit]
+        context = {"limit": limit, "returned": len(page)}
+        if offset + limit < len(features):
+            context["next"] = offset + limit
+        self.sendJson(200, {"type": "FeatureCollection", "features": page, "context": context})
+
+    def process(self, request):
+        state = self.state
+        state.Count("process")
+        output = request.get("output", {})
+        width, height = int(output.get("width", 512)), int(output.get("height", 512))
+        bounds = polygonBounds(request["input"]["bounds"]["geometry"]["coordinates"])
+        # Every acquisition day gets its own scene, a window without an acquisition returns an empty scene
+        timeRange = request["input"]["data"][0].get("dataFilter", {}).get("timeRange", {})
+        day = 0
+        if "to" in timeRange:
+            toDate = parseDate(timeRange["to"])
+            if toDate.toordinal() % state.RevisitDays == 0:
+                day = toDate.toordinal()
+        if "INT16" in request.get("evalscript", "").replace("UINT16", ""):
+            pixels = state.NdviPixels(width, height, day)
+        else:
+            pixels = state.Pixels(width, height, day)
+        if day == 0 or state.Roll() < state.MaskedRate:
+            state.Count("masked")
+            pixels = np.zeros_like(pixels)
+        payload = EncodeGeoTiff(pixels, bounds)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/tiff")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def StartMockServer(state, host="127.0.0.1", port=0):
+    """Starts the mock api on a background thread and returns the server, its url is http://host:server.server_port"""
+    handler = type("BoundMockCopernicusHandler", (MockCopernicusHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="MockCopernicusServer", daemon=True)
+    thread.start()
+    logging.info(f"Mock Copernicus api listening on http://{host}:{server.server_port}")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline stand-in for the Copernicus identity, Catalog and Process apis.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="Base latency in secounds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Maximum extra random latency in secounds")
+    parser.add_argument("--rate-401", type=float, default=0.0, help="Fraction of requests answered with 401")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="Fraction of requests answered with 5xx")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    state = MockCopernicusState(
+        Latency=args.latency,
+        Jitter=args.jitter,
+        UnauthorizedRate=args.rate_401,
+        RateLimitRate=args.rate_429,
+        ServerErrorRate=args.rate_5xx
+    )
+    server = StartMockServer(state, port=args.port)
+    print(f"Set CopernicusApiUrl and CopernicusIdentityUrl to http://127.0.0.1:{server.server_port}. Press CTRL+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
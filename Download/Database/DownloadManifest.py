@@ -0,0 +1,171 @@
+import sqlite3
+import logging
+import time
+import os
+from contextlib import contextmanager
+
+
+class DownloadManifest:
+    def __init__(self, ManifestFile="Pictures/manifest.sqlite"):
+        """
+        Durable record of the images that have been downloaded completely.
+        :param ManifestFile: Path of the sqlite file, shared by the workers on the host.
+        """
+        self.ManifestFile = ManifestFile
+        folder = os.path.dirname(ManifestFile)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS Downloads (
+                    FieldId TEXT NOT NULL,
+                    Date TEXT NOT NULL,
+                    Resolution TEXT NOT NULL,
+                    Path TEXT NOT NULL,
+                    CompletedAt REAL NOT NULL,
+                    PRIMARY KEY (FieldId, Date, Resolution)
+                )
+                """)
+            # Empty downloads had too few valid pixels, their file is not kept and Path is empty.
+            # GeometryHash is the polygon the download was made for, a field or box id can keep its id while its polygon changes
+            self._addMissingColumns(connection, {
+                "Size": "INTEGER", "Checksum": "TEXT", "StoreKey": "TEXT",
+                "ValidFraction": "REAL", "Empty": "INTEGER NOT NULL DEFAULT 0", "GeometryHash": "TEXT"
+            })
+            # Catalog of the raster files, read by the processing stage instead of opening every file
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS Rasters (
+                    Path TEXT PRIMARY KEY,
+                    MinLon REAL NOT NULL,
+                    MinLat REAL NOT NULL,
+                    MaxLon REAL NOT NULL,
+                    MaxLat REAL NOT NULL,
+                    Crs TEXT,
+                    PixelSizeX REAL,
+                    PixelSizeY REAL,
+                    Width INTEGER,
+                    Height INTEGER,
+                    ValidFraction REAL
+                )
+                """)
+            # Band set of the raster, rasters of different band sets have different bands and types and are never merged
+            self._addMissingColumns(connection, {"BandSet": "TEXT"}, "Rasters")
+            connection.execute("CREATE INDEX IF NOT EXISTS DownloadsStoreKey ON Downloads (StoreKey)")
+            connection.execute("CREATE INDEX IF NOT EXISTS DownloadsDate ON Downloads (Date)")
+            connection.execute("CREATE INDEX IF NOT EXISTS DownloadsChecksum ON Downloads (Checksum)")
+
+    @contextmanager
+    def _connect(self):
+        """Opens a connection for one transaction so the download threads and worker processes can share the file."""
+        connection = sqlite3.connect(self.ManifestFile, timeout=30)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _addMissingColumns(self, connection, columns, Table="Downloads"):
+        """Adds the columns introduced after the manifest file was created"""
+        existing = {row[1] for row in connection.execute(f"PRAGMA table_info({Table})")}
+        for name, columnType in columns.items():
+            if name not in existing:
+                connection.execute(f"ALTER TABLE {Table} ADD COLUMN {name} {columnType}")
+
+    def IsComplete(self, FieldId, Date, Resolution, GeometryHash=None):
+        """
+        Returns True when the image is recorded as downloaded and still exists on disk with the recorded size,
+        or when it is recorded as empty.
+        :param GeometryHash: Hash of the polygon to download, a download recorded for another or an unknown polygon is not complete.
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT Path, Size, Empty, GeometryHash FROM Downloads WHERE FieldId = ? AND Date = ? AND Resolution = ?",
+                (str(FieldId), str(Date), str(Resolution))
+            ).fetchone()
+        if row is None:
+            return False
+        if GeometryHash is not None and row[3] != GeometryHash:
+            logging.info(f"Manifest lists {FieldId} on {Date} for another polygon, it will be downloaded again")
+            return False
+        if row[2]:
+            return True
+        if not os.path.exists(row[0]):
+            logging.warning(f"Manifest lists {row[0]} but the file is missing, it will be downloaded again")
+            return False
+        if row[1] is not None and os.path.getsize(row[0]) != row[1]:
+            logging.warning(f"Manifest lists {row[0]} with {row[1]} bytes but the file has changed, it will be downloaded again")
+            return False
+        return True
+
+    def FindStored(self, StoreKey):
+        """Returns the Path, Size and Checksum of a raster in the raster store, or None when it is not stored yet."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT Path, Size, Checksum FROM Downloads WHERE StoreKey = ? AND Empty = 0",
+                (StoreKey,)
+            ).fetchall()
+        for Path, Size, Checksum in rows:
+            if os.path.exists(Path) and (Size is None or os.path.getsize(Path) == Size):
+                return Path, Size, Checksum
+        return None
+
+    def FindByChecksum(self, Checksum):
+        """Returns the Path, Size and Checksum of a stored raster downloaded with the checksum, or None when there is none."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT Path, Size, Checksum FROM Downloads WHERE Checksum = ? AND StoreKey IS NOT NULL AND Empty = 0",
+                (Checksum,)
+            ).fetchall()
+        for Path, Size, Checksum in rows:
+            if os.path.exists(Path) and (Size is None or os.path.getsize(Path) == Size):
+                return Path, Size, Checksum
+        return None
+
+    def FindEmpty(self, StoreKey):
+        """Returns the valid fraction of a raster store key recorded as empty, or None when it is not recorded as empty."""
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT ValidFraction FROM Downloads WHERE StoreKey = ? AND Empty = 1 LIMIT 1",
+                (StoreKey,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def FieldIdsForStoreKey(self, StoreKey):
+        """Returns the FieldIds whose downloads resolved to the raster with the key."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT FieldId FROM Downloads WHERE StoreKey = ? ORDER BY CompletedAt",
+                (StoreKey,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def MarkComplete(self, FieldId, Date, Resolution, Path, Size=None, Checksum=None, StoreKey=None, ValidFraction=None, GeometryHash=None):
+        """Records a finished download, call it only after the image has been renamed into place."""
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO Downloads (FieldId, Date, Resolution, Path, CompletedAt, Size, Checksum, StoreKey, ValidFraction, Empty, GeometryHash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)",
+                (str(FieldId), str(Date), str(Resolution), Path, time.time(), Size, Checksum, StoreKey, ValidFraction, GeometryHash)
+            )
+
+    def RecordRaster(self, Path, Info, BandSet=None):
+        """
+        Records the footprint of a raster file in the raster catalog.
+        :param Info: Dictionary with MinLon, MinLat, MaxLon and MaxLat in EPSG:4326, Crs, PixelSizeX, PixelSizeY, Width, Height and ValidFraction.
+        :param BandSet: Band set the raster was downloaded with, Raw or Ndvi.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO Rasters (Path, MinLon, MinLat, MaxLon, MaxLat, Crs, PixelSizeX, PixelSizeY, Width, Height, ValidFraction, BandSet) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (Path, Info["MinLon"], Info["MinLat"], Info["MaxLon"], Info["MaxLat"], Info["Crs"],
+                 Info["PixelSizeX"], Info["PixelSizeY"], Info["Width"], Info["Height"], Info["ValidFraction"], BandSet)
+            )
+
+    def MarkEmpty(self, FieldId, Date, Resolution, ValidFraction, Checksum=None, StoreKey=None, GeometryHash=None):
+        """Records a download whose image had too few valid pixels to keep, so it is neither downloaded nor processed again."""
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO Downloads (FieldId, Date, Resolution, Path, CompletedAt, Size, Checksum, StoreKey, ValidFraction, Empty, GeometryHash) VALUES (?, ?, ?, '', ?, NULL, ?, ?, ?, 1, ?)",
+                (str(FieldId), str(Date), str(Resolution), time.time(), Checksum, StoreKey, ValidFraction, GeometryHash)
+            )
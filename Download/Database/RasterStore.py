@@ -0,0 +1,47 @@
+import hashlib
+import logging
+import os
+import shapely
+from shapely.geometry import shape
+
+
+def GeometryHash(Polygon):
+    """Hash of the polygon that does not change with the vertex order or tiny floating point differences."""
+    geometry = shapely.set_precision(shape({"type": "Polygon", "coordinates": Polygon}), 1e-9).normalize()
+    return hashlib.sha1(shapely.to_wkb(geometry, hex=True).encode()).hexdigest()
+
+
+class RasterStore:
+    def __init__(self, Root="Pictures/Store"):
+        """
+        Shared store of the downloaded rasters, where every raster is saved once under a key of what was requested.
+        Rasters are sharded as Root/{Date}/{key[:2]}/{key}.tiff, so the rasters of a date are in one folder
+        and no folder holds too many files.
+        :param Root: Folder of the store, shared by the workers on the host.
+        """
+        self.Root = Root
+        os.makedirs(Root, exist_ok=True)
+
+    def Key(self, Polygon, Date, Resolution, BandSet):
+        """Key of the raster of the polygon on the date, at the resolution and with the bands in the band set."""
+        return hashlib.sha1(f"{GeometryHash(Polygon)}|{Date}|{Resolution}|{BandSet}".encode()).hexdigest()
+
+    def PathFor(self, Key, Date):
+        return os.path.join(self.Root, str(Date), Key[:2], f"{Key}.tiff")
+
+    def Commit(self, TempPath, Path):
+        """
+        Moves a finished temporary file into the store.
+        When another worker stored the same raster first the temporary file is dropped, so every raster is written once.
+        Returns True when this file was stored.
+        """
+        os.makedirs(os.path.dirname(Path), exist_ok=True)
+        try:
+            # A hard link fails when the path exists, unlike a rename which would replace it
+            os.link(TempPath, Path)
+        except FileExistsError:
+            logging.info(f"{Path} is already in the raster store, dropping the duplicate download")
+            os.remove(TempPath)
+            return False
+        os.remove(TempPath)
+        return True
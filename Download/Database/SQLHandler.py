@@ -66,7 +66,19 @@ class SQLHandler:
                 FullDate VARCHAR(255) NOT NULL,
                 DateOnly VARCHAR(255) NOT NULL,
                 Platform VARCHAR(255) NOT NULL,
-                CloudCover Float NOT NULL
+                CloudCover Float NOT NULL,
+                UNIQUE KEY UniqueBoundingBoxDate (BoundingBoxId, FullDate)
+            );
+            """
+            self.cursor.execute(create_table_query)
+            self.connection.commit()
+            self.addBoundingboxMetaDataUniqueKey()
+
+            create_table_query = """
+            CREATE TABLE IF NOT EXISTS FieldTileCoverage(
+                TileId VARCHAR(255) NOT NULL,
+                FieldId INT NOT NULL,
+                PRIMARY KEY (TileId, FieldId)
             );
             """
             self.cursor.execute(create_table_query)
@@ -111,35 +123,71 @@ class SQLHandler:
         return fieldDict
 
 
+    def addBoundingboxMetaDataUniqueKey(self):
+        """Adds the (BoundingBoxId, FullDate) unique key to tables created before it was part of the schema"""
+        self.cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = 'BoundingboxMetaData' AND index_name = 'UniqueBoundingBoxDate'
+            """)
+        if self.cursor.fetchone()[0] > 0:
+            return
+
+        # Keep the newest row of every duplicate so the unique key can be created
+        self.cursor.execute("""
+            DELETE older FROM BoundingboxMetaData older
+            INNER JOIN BoundingboxMetaData newer
+            ON older.BoundingBoxId = newer.BoundingBoxId AND older.FullDate = newer.FullDate AND older.MetaDataID < newer.MetaDataID
+            """)
+        logging.info(f"Removed {self.cursor.rowcount} duplicate BoundingboxMetaData rows")
+        self.cursor.execute("ALTER TABLE BoundingboxMetaData ADD UNIQUE KEY UniqueBoundingBoxDate (BoundingBoxId, FullDate)")
+        self.connection.commit()
+        logging.info("Added the unique key on BoundingBoxId and FullDate to BoundingboxMetaData")
+
     def insertBoundingboxMetaData(self, metadata):
         """Method that inserts all metadata from the features"""
+        self.insertBoundingboxMetaDataBatch([metadata])
+
+    def insertBoundingboxMetaDataBatch(self, ListOfMetaData, batch_size=1000):
+        """Method that upserts the metadata of many features with one statement and commit per batch"""
+        if not ListOfMetaData:
+            return
         try:
-            self.cursor.execute("SELECT * FROM BoundingboxMetaData WHERE BoundingBoxId=%s AND FullDate=%s", (metadata[0], metadata[1]))
-            foundMetaData = self.cursor.fetchone()
-
-            if foundMetaData is not None:
-                query = """
-                UPDATE BoundingboxMetaData 
-                SET DateOnly=%s, Platform=%s, CloudCover=%s 
-                WHERE BoundingBoxId=%s AND FullDate=%s
-                """
-                values = (metadata[2], metadata[3], metadata[4], metadata[0], metadata[1])
-                logging.info(f"MetaData for {metadata[0]} on the {metadata[1]} has been updated")
-            else:
-                query = """
+            for i in range(0, len(ListOfMetaData), batch_size):
+                batch = ListOfMetaData[i:i + batch_size]
+                query = f"""
                 INSERT INTO BoundingboxMetaData (BoundingBoxId, FullDate, DateOnly, Platform, CloudCover)
-                VALUES (%s, %s, %s, %s, %s)
+                VALUES {", ".join(["(%s, %s, %s, %s, %s)"] * len(batch))}
+                ON DUPLICATE KEY UPDATE DateOnly=VALUES(DateOnly), Platform=VALUES(Platform), CloudCover=VALUES(CloudCover)
                 """
-                values = metadata
-                logging.info(f"MetaData for {metadata[0]} on the {metadata[1]} has been inserted")
-
-            self.cursor.execute(query, values)
+                values = [value for metadata in batch for value in metadata]
+                self.cursor.execute(query, values)
             self.connection.commit()
+            logging.info(f"Upserted {len(ListOfMetaData)} MetaData rows for {ListOfMetaData[0][0]}")
 
         except mysql.connector.Error as err:
             logging.error(f"Error inserting data: {err}")
 
 
+    def insertFieldTileCoverage(self, tiles, batch_size=1000):
+        """Method that records which fields every planned download tile covers"""
+        rows = [(tileId, fieldId) for tileId, (_, fieldIds) in tiles.items() for fieldId in fieldIds]
+        if not rows:
+            return
+        try:
+            for i in range(0, len(rows), batch_size):
+                batch = rows[i:i + batch_size]
+                query = f"""
+                INSERT IGNORE INTO FieldTileCoverage (TileId, FieldId)
+                VALUES {", ".join(["(%s, %s)"] * len(batch))}
+                """
+                values = [value for row in batch for value in row]
+                self.cursor.execute(query, values)
+            self.connection.commit()
+            logging.info(f"Recorded {len(rows)} field coverages for {len(tiles)} tiles")
+
+        except mysql.connector.Error as err:
+            logging.error(f"Error inserting data: {err}")
+
 
 if __name__ == "__main__":
     
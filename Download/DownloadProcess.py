@@ -4,10 +4,17 @@ import logging, dotenv, os, time , sys,csv,argparse,re
 from shapely.geometry import box
 from shapely.wkt import dumps
 from Gis.WktHandler import ConvertWktToNestedCords
+from Gis.FieldTilePlanner import PlanFieldTiles
+from Gis.OutputSize import ParseGsd
 from Database.SQLHandler import SQLHandler
+from Database.DownloadManifest import DownloadManifest
+from Database.RasterStore import RasterStore
 from Api.CatalogApiHandler import CatalogApiHandler
 from Api.TokenApiHandler import TokenApiHandler
 from Api.ProcessApiHandler import ProcessApiHandler
+from Api.ProcessFetchEngine import ProcessFetchEngine
+from Api.CatalogCache import CatalogCache
+from Api.RateLimiter import CreateRateLimiter
     
 workername = ""
 
@@ -20,39 +27,107 @@ def setup_logging(log_file="Download.log"):
     )
     logging.info(f"Logging initialized. Writing to {log_file}")
 
-def DownloadProcess(FromDate,ToDate,mode,region,resolution):
-    logging.info(f"Starting the DownloadProcess using the dates {FromDate}, {ToDate}, the mode: {mode}, the region: {region} and the picture resolution: {resolution}")
+def CreateDownloadHandlers(db_handler=None, Token_ApiHandler=None, Rate_Limiter=None, Session=None):
+    """
+    Creates the database connection and API handlers used by DownloadProcess.
+    A long running worker creates them once and reuses them for every message.
+    :param db_handler: Existing database handler, a new connection is made when left out.
+    :param Token_ApiHandler: Existing token handler, so several handler sets can share one token.
+    :param Rate_Limiter: Existing rate limiter, so several handler sets share one request schedule.
+    :param Session: HTTP session of the handlers, the session shared by the process when left out.
+    """
     dotenvFile = dotenv.find_dotenv()
     dotenv.load_dotenv(dotenvFile)
 
-    db_handler = SQLHandler(
-        host=os.getenv("SQLHOST"),
-        user=os.getenv("DBUSER"),
-        password=os.getenv("DBPASSWORD"),
-        database=os.getenv("DBDB")
-    )
+    if db_handler is None:
+        db_handler = SQLHandler(
+            host=os.getenv("SQLHOST"),
+            user=os.getenv("DBUSER"),
+            password=os.getenv("DBPASSWORD"),
+            database=os.getenv("DBDB")
+        )
     
-    Token_ApiHandler = TokenApiHandler(
-        ClientId=os.getenv("ApiClienId"),
-        ClientSecret=os.getenv("ApiClienSecret"),
-    )
+    if Token_ApiHandler is None:
+        Token_ApiHandler = TokenApiHandler(
+            ClientId=os.getenv("ApiClienId"),
+            ClientSecret=os.getenv("ApiClienSecret"),
+            Session=Session,
+            CacheFile=os.getenv("TokenCacheFile")
+        )
+
+    if Rate_Limiter is None:
+        Rate_Limiter = CreateRateLimiter()
+
+    Catalog_Cache = None
+    if os.getenv("CatalogCacheFile", "CatalogCache.sqlite"):
+        Catalog_Cache = CatalogCache(
+            CacheFile=os.getenv("CatalogCacheFile", "CatalogCache.sqlite"),
+            TimeToLive=float(os.getenv("CatalogCacheTTL", 7 * 24 * 3600)),
+            MaxBytes=int(float(os.getenv("CatalogCacheMaxMB", 256)) * 1024 * 1024)
+        )
 
     Catalog_ApiHandler = CatalogApiHandler(
-        ApiToken=os.getenv("APIToken"),
+        ApiToken=None,
         TokenApiHandler=Token_ApiHandler,
-        dbHandler=db_handler
+        dbHandler=db_handler,
+        Session=Session,
+        Cache=Catalog_Cache,
+        RateLimiter=Rate_Limiter
     )
     
     Process_ApiHandler = ProcessApiHandler(
-        ApiToken=os.getenv("APIToken"),
+        ApiToken=None,
         TokenApiHandler=Token_ApiHandler,
-        SQLHandler=db_handler
+        SQLHandler=db_handler,
+        Session=Session,
+        Manifest=DownloadManifest(os.getenv("DownloadManifestFile", "Pictures/manifest.sqlite")),
+        Compression=None if os.getenv("DownloadCompression", "DEFLATE").upper() == "NONE" else os.getenv("DownloadCompression", "DEFLATE").upper(),
+        RateLimiter=Rate_Limiter,
+        Store=RasterStore(os.getenv("RasterStoreRoot", "Pictures/Store")) if os.getenv("RasterStoreRoot", "Pictures/Store") else None
     )
-    
+
+    return {
+        "db_handler": db_handler,
+        "Token_ApiHandler": Token_ApiHandler,
+        "Rate_Limiter": Rate_Limiter,
+        "Catalog_Cache": Catalog_Cache,
+        "Catalog_ApiHandler": Catalog_ApiHandler,
+        "Process_ApiHandler": Process_ApiHandler
+    }
+
+def DownloadProcess(FromDate,ToDate,mode,region,resolution,maxCloud=None,bandSet="Raw",db_handler=None,handlers=None,WorkerName=None):
+    """
+    Downloads every image in the date range and returns the throughput of the Process API requests.
+    :param bandSet: Raw downloads the Red, NIR and mask bands, Ndvi downloads NDVI computed by the API and the mask.
+    :param handlers: Handlers from CreateDownloadHandlers, new ones are created when left out.
+    :param WorkerName: Name of the folder the pictures are saved under, defaults to the workername of the process.
+    """
+    logging.info(f"Starting the DownloadProcess using the dates {FromDate}, {ToDate}, the mode: {mode}, the region: {region}, the picture resolution: {resolution}, the max cloud cover: {maxCloud} and the band set: {bandSet}")
+    if handlers is None:
+        handlers = CreateDownloadHandlers(db_handler=db_handler)
+    db_handler = handlers["db_handler"]
+    Catalog_Cache = handlers["Catalog_Cache"]
+    Catalog_ApiHandler = handlers["Catalog_ApiHandler"]
+    Process_ApiHandler = handlers["Process_ApiHandler"]
+    # The handlers can be reused between runs, so only the pages of this run are logged
+    pageCountBefore = Catalog_ApiHandler.TotalPageCount
+    catalogLatencyBefore = Catalog_ApiHandler.TotalCatalogLatency
+    cacheHitsBefore, cacheMissesBefore = (Catalog_Cache.Hits, Catalog_Cache.Misses) if Catalog_Cache is not None else (0, 0)
+
     polygondict = {}
+    fieldTiles = {}
     if mode == "Field":
         logging.info("DownloadProcess will use Fields")
-        polygondict = db_handler.getAllFieldPolygons()
+        # Nearby fields are downloaded together in tiles instead of one request per field
+        fieldPolygons = db_handler.getAllFieldPolygons()
+        gsd = ParseGsd(resolution)
+        if gsd is None:
+            fieldTiles = PlanFieldTiles(fieldPolygons, MaxPixels=int(resolution))
+        else:
+            # Tiles are as large as the output cap allows at the ground sampling distance
+            fieldTiles = PlanFieldTiles(fieldPolygons, MaxPixels=Process_ApiHandler.MaxOutputPixels, Gsd=gsd)
+        db_handler.insertFieldTileCoverage(fieldTiles)
+        polygondict = {tileId: tileWkt for tileId, (tileWkt, _) in fieldTiles.items()}
     elif mode == "BB":
         logging.info("DownloadProcess will use boundingboxes")
         if region == "Fyn":
@@ -89,51 +164,73 @@ def DownloadProcess(FromDate,ToDate,mode,region,resolution):
         csvwriter.writerow(fields)
     """
 
-    WorkerName = workername
-    # Iterate through each regionBB
-    for id,wkt in polygondict.items():
-        FieldId = id
-        sleeptimer=1
+    if WorkerName is None:
+        WorkerName = workername
+    Fetch_Engine = ProcessFetchEngine(
+        ProcessApiHandler=Process_ApiHandler,
+        Concurrency=os.getenv("DownloadConcurrency", 8)
+    )
+    
+    # The engine is always shut down, so a failed run does not leave download threads behind in a long running worker
+    try:
+        # Iterate through each regionBB
+        for id,wkt in polygondict.items():
+            FieldId = id
         
-        # Convert WKT Polygons to NestedCords
-        nestedBB = ConvertWktToNestedCords(wkt)
-
-        # Call the Catalog API to get image dates
-        CatalogData = Catalog_ApiHandler.GetPictureDates(Polygon=nestedBB, FieldId=FieldId,FromDate=FromDate,ToDate=ToDate)
-
-        if not CatalogData:
-            logging.warning(f"No image dates found for polygon with id {FieldId}, skipping...")
-            continue
-
-        logging.info(f"Catalog API found {len(CatalogData)} dates for polygon with id {FieldId}")
-
-        dotenv.load_dotenv(dotenvFile)
-
-        # Sleep to ensure API stability
-        time.sleep(sleeptimer)
-
-        # Process each date
-        for date in CatalogData:
-            try:
-                Process_ApiHandler.processDateIntoImages(date, nestedBB, FieldId,resolution, WorkerName)
-            except Exception as e:
-                logging.error(f"Error processing date {date} for polygon with id {FieldId}: {e}")
-
+            # Convert WKT Polygons to NestedCords
+            nestedBB = ConvertWktToNestedCords(wkt)
+
+            # Call the Catalog API to get image dates, tiles are searched once and the scenes are joined to their fields
+            if FieldId in fieldTiles:
+                tileFieldPolygons = {fieldId: fieldPolygons[fieldId] for fieldId in fieldTiles[FieldId][1]}
+                CatalogData = Catalog_ApiHandler.GetFieldPictureDates(Polygon=nestedBB, TileId=FieldId, FieldPolygons=tileFieldPolygons, FromDate=FromDate, ToDate=ToDate, MaxCloudCover=maxCloud)
+            else:
+                CatalogData = Catalog_ApiHandler.GetPictureDates(Polygon=nestedBB, FieldId=FieldId,FromDate=FromDate,ToDate=ToDate,MaxCloudCover=maxCloud)
+
+            if not CatalogData:
+                logging.warning(f"No image dates found for polygon with id {FieldId}, skipping...")
+                continue
+
+            logging.info(f"Catalog API found {len(CatalogData)} dates for polygon with id {FieldId}")
+
+            # Queue each date, the fetch engine downloads them concurrently while the next polygons are cataloged
+            for date, acquisitions in CatalogData.items():
+                Fetch_Engine.Submit(date, nestedBB, FieldId, resolution, WorkerName, acquisitions, bandSet)
+
+        FetchStats = Fetch_Engine.Wait()
+    finally:
+        Fetch_Engine.Shutdown()
+    logging.info(f"Catalog API used {Catalog_ApiHandler.TotalPageCount - pageCountBefore} pages in {Catalog_ApiHandler.TotalCatalogLatency - catalogLatencyBefore:.1f} secounds")
+    Rate_Limiter = handlers.get("Rate_Limiter")
+    if Rate_Limiter is not None:
+        logging.info(f"Rate limiter has retried {Rate_Limiter.RetryCount} requests, {Rate_Limiter.RateLimitedCount} were rate limited, a request spends about {Rate_Limiter.UnitEstimate} processing units")
+    if Catalog_Cache is not None:
+        logging.info(f"Catalog cache answered {Catalog_Cache.Hits - cacheHitsBefore} searches and missed {Catalog_Cache.Misses - cacheMissesBefore}")
     logging.info(f"Completed the download proccess on the dates from: {FromDate} To: {ToDate}")
+    return FetchStats
     
     
 def validate_message_data(message_data):
     """Validates the MessagesData format."""
-    DATEPATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\|\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\|\w+\|(\w+| )\|\d{3,4}$")
+    DATEPATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\|\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\|\w+\|(\w+| )\|(\d{3,4}|(?!0+(\.0+)?m)\d{1,3}(\.\d+)?m)(\|\d{1,3}(\.\d+)?)?(\|(Raw|Ndvi))?$")
     if not DATEPATTERN.match(message_data):
         logging.error(f"Invalid MessagesData format: {message_data}")
         sys.exit(4)
-    return message_data.split("|")
+    MessageParts = message_data.split("|")
+    # The max cloud cover and the band set are optional, without them every date is downloaded with the Raw bands
+    maxCloud = None
+    bandSet = "Raw"
+    for Part in MessageParts[5:]:
+        if Part in ("Raw", "Ndvi"):
+            bandSet = Part
+        else:
+            maxCloud = float(Part)
+    return MessageParts[:5] + [maxCloud, bandSet]
 
 def main():
     """Main function to handle argument parsing and processing."""
     parser = argparse.ArgumentParser(description="Process and download satellite data.")
-    parser.add_argument("MessagesData", help="Data in format YYYY-MM-DDTHH:MM:SSZ|YYYY-MM-DDTHH:MM:SSZ|Mode|region|resolution")
+    parser.add_argument("MessagesData", help="Data in format YYYY-MM-DDTHH:MM:SSZ|YYYY-MM-DDTHH:MM:SSZ|Mode|region|resolution[|maxCloud][|Raw|Ndvi]")
     parser.add_argument("LogFile", nargs="?", default="download_process.log", help="Log file name (default: download_process.log)")
 
     args = parser.parse_args()
@@ -146,10 +243,10 @@ def main():
         print(workername)
     logging.info(f"Received MessagesData: {args.MessagesData}")
 
-    FromDate, ToDate, Mode, Region, Resolution = validate_message_data(args.MessagesData)
+    FromDate, ToDate, Mode, Region, Resolution, MaxCloud, BandSet = validate_message_data(args.MessagesData)
     logging.info(f"Validated date range: From {FromDate} to {ToDate}")
     starttime = time.time()
-    DownloadProcess(FromDate, ToDate,Mode,Region,Resolution)
+    DownloadProcess(FromDate, ToDate,Mode,Region,Resolution,MaxCloud,BandSet)
     endTime = time.time()
     logging.info(f"The process took {endTime-starttime} secounds")
 
@@ -1,17 +1,22 @@
 import pika
 import subprocess
 import re
+import os
 import sys
+import queue
 import logging
 import argparse
 import concurrent.futures
 
 DATEPATTERN = re.compile(
-    r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\|\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\|\w+\|(\w+| )\|\d{3,4}$"
+    r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\|\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\|\w+\|(\w+| )\|(\d{3,4}|(?!0+(\.0+)?m)\d{1,3}(\.\d+)?m)(\|\d{1,3}(\.\d+)?)?(\|(Raw|Ndvi))?$"
 )
 
 log_filename = "download_process.log"
 
+# Warm handler sets of the in-process mode, each message borrows one for the time it runs
+download_slots = None
+
 def setup_logging(log_filename):
     logging.basicConfig(
         filename=log_filename,
@@ -33,6 +38,49 @@ def process_download(message, log_filename):
     exit_code = process.wait()
     return exit_code
 
+def create_download_slots(slots):
+    """
+    Creates one set of handlers, database connection and HTTP session per slot. The slots share a single API token and rate limiter.
+    Every slot has its own connection pool, a shared pool only holds the connections of one slot.
+    """
+    from DownloadProcess import CreateDownloadHandlers
+    from Api.HttpSession import CreateSession
+
+    download_slots = queue.Queue()
+    Token_ApiHandler = None
+    Rate_Limiter = None
+    for slot in range(slots):
+        handlers = CreateDownloadHandlers(Token_ApiHandler=Token_ApiHandler, Rate_Limiter=Rate_Limiter, Session=CreateSession())
+        Token_ApiHandler = handlers["Token_ApiHandler"]
+        Rate_Limiter = handlers["Rate_Limiter"]
+        download_slots.put(handlers)
+    logging.info(f"Created {slots} warm download slots")
+    return download_slots
+
+def process_download_in_process(message, log_filename):
+    """Runs the download process in this process with warm handlers and returns the exit code the subprocess would have used."""
+    from DownloadProcess import DownloadProcess, validate_message_data
+
+    logging.info(f"Starting in-process download with message: {message}")
+    handlers = download_slots.get()
+    try:
+        db_handler = handlers["db_handler"]
+        if db_handler.connection is None or not db_handler.connection.is_connected():
+            logging.warning("Database connection of the download slot was lost, reconnecting...")
+            db_handler.connect()
+
+        FromDate, ToDate, Mode, Region, Resolution, MaxCloud, BandSet = validate_message_data(message)
+        DownloadProcess(FromDate, ToDate, Mode, Region, Resolution, MaxCloud, BandSet, handlers=handlers, WorkerName=os.path.splitext(log_filename)[0])
+        return 0
+    except SystemExit as e:
+        # DownloadProcess exits with 4 for messages it does not support
+        return e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        logging.exception(f"In-process download failed: {str(e)}")
+        return 1
+    finally:
+        download_slots.put(handlers)
+
 def callback(ch, method, properties, body, executor):
     """Callback that offloads the download task to a thread."""
     message = body.decode().strip()
@@ -43,7 +91,8 @@ def callback(ch, method, properties, body, executor):
         ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
         return
 
-    future = executor.submit(process_download, message, log_filename)
+    run_download = process_download_in_process if download_slots is not None else process_download
+    future = executor.submit(run_download, message, log_filename)
 
     def on_done(f):
         try:
@@ -73,14 +122,23 @@ def shutdown_handler(channel, connection, executor):
     logging.info("RabbitMQ connection closed. Exiting gracefully.")
     sys.exit(0)
 
-def consume():
+def consume(slots=1, in_process=False):
+    """
+    Consumes download messages with a number of parallel slots.
+    :param slots: Number of messages processed at the same time, the prefetch count matches it.
+    :param in_process: Run the downloads in this process with warm handlers instead of a subprocess per message.
+    """
+    global download_slots
+    if in_process:
+        download_slots = create_download_slots(slots)
+
     connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost', heartbeat=30))
     channel = connection.channel()
     channel.queue_declare(queue='Download_task_queue', durable=True)
-    channel.basic_qos(prefetch_count=1)
+    channel.basic_qos(prefetch_count=slots)
 
 
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=slots, thread_name_prefix="DownloadSlot")
 
 
     on_message_callback = lambda ch, method, properties, body: callback(ch, method, properties, body, executor)
@@ -99,11 +157,15 @@ def consume():
 def main():
     parser = argparse.ArgumentParser(description="RabbitMQ worker for processing downloads.")
     parser.add_argument("LogFile", nargs="?", default="download_process.log", help="Log file name (default: download_process.log)")
+    parser.add_argument("--slots", type=int, default=int(os.getenv("DownloadSlots", 1)), help="Number of messages downloaded in parallel (default: 1)")
+    parser.add_argument("--in-process", action="store_true", help="Run downloads in the worker with warm handlers instead of a subprocess per message")
     args = parser.parse_args()
+    if args.slots < 1:
+        parser.error("--slots must be at least 1")
     global log_filename
     log_filename = f"{args.LogFile}.log"
     setup_logging(log_filename)
-    consume()
+    consume(slots=args.slots, in_process=args.in_process)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,25 @@
+import logging
+import rasterio
+from rasterio.shutil import copy as copyRaster
+
+
+def ConvertToCog(SourcePath, DestinationPath, Compression="DEFLATE", BlockSize=256):
+    """
+    Rewrites a GeoTIFF as a Cloud Optimized GeoTIFF with internal tiles, overviews and lossless compression,
+    so readers can fetch only the blocks a polygon touches.
+    :param Compression: DEFLATE, ZSTD or LZW, ZSTD needs a GDAL build with zstd support.
+    """
+    with rasterio.open(SourcePath) as src:
+        # The horizontal predictor helps integer bands, floating point bands need the floating point predictor
+        predictor = "FLOATING_POINT" if src.dtypes[0].startswith("float") else "YES"
+        copyRaster(
+            src,
+            DestinationPath,
+            driver="COG",
+            COMPRESS=Compression,
+            PREDICTOR=predictor,
+            BLOCKSIZE=BlockSize,
+            OVERVIEWS="AUTO",
+            OVERVIEW_RESAMPLING="NEAREST",
+        )
+    logging.debug(f"Converted {SourcePath} into a {Compression} compressed COG {DestinationPath}")
@@ -0,0 +1,66 @@
+import math
+import logging
+import numpy as np
+import shapely
+from shapely.geometry import box
+from shapely.wkt import dumps
+
+# Length of one degree of latitude in meters, a degree of longitude is this times cos(latitude)
+METERS_PER_DEGREE = 111320.0
+
+
+def PlanFieldTiles(fieldDict, MaxPixels=1024, Gsd=10.0):
+    """
+    Clusters field polygons into request tiles that are at most MaxPixels wide and high at the ground sampling distance Gsd.
+    The fields are bucketed on a fixed grid by the center of their bounds, so tile ids are stable between runs,
+    and each tile is shrunk to the bounds of its fields so no empty area is requested.
+    :param fieldDict: Dictionary of FieldId to polygon WKT, as returned by SQLHandler.getAllFieldPolygons.
+    :param MaxPixels: Maximum width and height of a tile in pixels.
+    :param Gsd: Ground sampling distance in meters per pixel.
+    Returns a dictionary of TileId to (tile polygon WKT, list of FieldIds the tile covers).
+    """
+    if not fieldDict:
+        return {}
+
+    fieldIds = np.array(list(fieldDict.keys()), dtype=object)
+    geometries = shapely.from_wkt(list(fieldDict.values()))
+    bounds = shapely.bounds(geometries)
+    centerLon = (bounds[:, 0] + bounds[:, 2]) / 2
+    centerLat = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    # Cells are sized at the southern edge of their row, where a degree of longitude is longest
+    tileMeters = MaxPixels * Gsd
+    tileHeight = tileMeters / METERS_PER_DEGREE
+    rows = np.floor(centerLat / tileHeight).astype(np.int64)
+    tileWidths = tileMeters / (METERS_PER_DEGREE * np.cos(np.radians(rows * tileHeight)))
+    cols = np.floor(centerLon / tileWidths).astype(np.int64)
+
+    # Sort the fields by cell so every cell is a contiguous segment
+    order = np.lexsort((cols, rows))
+    rows, cols, bounds = rows[order], cols[order], bounds[order]
+    cellStarts = np.flatnonzero(np.r_[True, (np.diff(rows) != 0) | (np.diff(cols) != 0)])
+    tileBounds = np.column_stack([
+        np.minimum.reduceat(bounds[:, 0], cellStarts),
+        np.minimum.reduceat(bounds[:, 1], cellStarts),
+        np.maximum.reduceat(bounds[:, 2], cellStarts),
+        np.maximum.reduceat(bounds[:, 3], cellStarts),
+    ])
+
+    tree = shapely.STRtree(geometries)
+    tiles = {}
+    for cellStart, (minLon, minLat, maxLon, maxLat) in zip(cellStarts, tileBounds):
+        # Tiles on the default 10 meter grid keep their ids, other grids are told apart by the distance
+        gridName = f"{MaxPixels}" if Gsd == 10.0 else f"{MaxPixels}_{Gsd:g}m"
+        tileId = f"FieldTile_{gridName}_{rows[cellStart]}_{cols[cellStart]}"
+        tileBox = box(minLon, minLat, maxLon, maxLat)
+
+        widthMeters = (maxLon - minLon) * METERS_PER_DEGREE * math.cos(math.radians(minLat))
+        heightMeters = (maxLat - minLat) * METERS_PER_DEGREE
+        if max(widthMeters, heightMeters) > tileMeters * 1.5:
+            logging.warning(f"Tile {tileId} spans {widthMeters:.0f}x{heightMeters:.0f} meters because of large fields, it is sampled coarser than {Gsd} meters")
+
+        coveredFields = fieldIds[tree.query(tileBox, predicate="covers")].tolist()
+        tiles[tileId] = (dumps(tileBox), coveredFields)
+
+    logging.info(f"Planned {len(tiles)} tiles of at most {MaxPixels} pixels at {Gsd} meters for {len(fieldDict)} fields")
+    return tiles
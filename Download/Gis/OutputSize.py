@@ -0,0 +1,51 @@
+import math
+import re
+from Gis.FieldTilePlanner import METERS_PER_DEGREE
+
+# Largest width or height the Process API returns
+MAX_OUTPUT_PIXELS = 2500
+
+# A resolution is either a fixed size in pixels, like 1024, or a ground sampling distance in meters, like 10m
+GSD_PATTERN = re.compile(r"^(\d{1,3}(\.\d+)?)m$")
+
+
+def ParseGsd(resolution):
+    """
+    Returns the ground sampling distance in meters of a resolution like 10m, or None for a fixed size in pixels.
+    Raises ValueError for a distance of 0m, which has no pixel size.
+    """
+    match = GSD_PATTERN.match(str(resolution))
+    if not match:
+        return None
+    gsd = float(match.group(1))
+    if gsd <= 0:
+        raise ValueError(f"Ground sampling distance must be above 0 meters, got {resolution}")
+    return gsd
+
+
+def OutputSize(Polygon, resolution, MaxPixels=MAX_OUTPUT_PIXELS):
+    """
+    Returns the width and height in pixels of the Process API output for the polygon.
+    A fixed resolution gives a square of that size, a ground sampling distance sizes the output to the extent of the polygon
+    with the aspect ratio kept, scaled down when a side would be larger than MaxPixels.
+    :param Polygon: Nested coordinates of the polygon in EPSG:4326.
+    :param resolution: Pixels, like 1024, or meters per pixel, like 10m.
+    :param MaxPixels: Largest width or height.
+    """
+    gsd = ParseGsd(resolution)
+    if gsd is None:
+        return int(resolution), int(resolution)
+
+    lons = [point[0] for point in Polygon[0]]
+    lats = [point[1] for point in Polygon[0]]
+    middleLat = (min(lats) + max(lats)) / 2
+    widthMeters = (max(lons) - min(lons)) * METERS_PER_DEGREE * math.cos(math.radians(middleLat))
+    heightMeters = (max(lats) - min(lats)) * METERS_PER_DEGREE
+
+    width = max(1, math.ceil(widthMeters / gsd))
+    height = max(1, math.ceil(heightMeters / gsd))
+    if max(width, height) > MaxPixels:
+        scale = MaxPixels / max(width, height)
+        width = max(1, min(MaxPixels, round(width * scale)))
+        height = max(1, min(MaxPixels, round(height * scale)))
+    return width, height
@@ -1,59 +1,141 @@
+import os
+import sys
+import logging
+import argparse
+import dotenv
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import box
+import shapely
 
-# Define Denmark's approximate bounding box in EPSG:4326
-west, east = 7.9, 15.2   # Longitude range
-south, north = 54.5, 57.8  # Latitude range
+# Length of one degree of latitude in meters, a degree of longitude is this times cos(latitude)
+METERS_PER_DEGREE = 111320.0
 
-# Approximate degrees per pixel at Denmark's latitude (~55°N)
-# 1 degree latitude = ~111 km, 1 degree longitude = ~111 * cos(latitude)
-# Assuming 50 pixels represent ~0.05 degrees latitude
-lat_step = 0.05
-lon_step = 0.05  # Approximate, as longitude distance varies with latitude
+# Denmark's approximate bounding box in EPSG:4326
+DENMARK_BOUNDS = (7.9, 54.5, 15.2, 57.8)
 
-# Adjust step size for 256-pixel grid
-lat_step_256 = (256 / 50) * lat_step
-lon_step_256 = (256 / 50) * lon_step
+# 256 pixels at ~0.05 degrees per 50 pixels, the box size of the original fixed grid
+BASE_STEP = (256 / 50) * 0.05
 
-# Generate grid
-lats_256 = np.arange(south, north, lat_step_256)
-lons_256 = np.arange(west, east, lon_step_256)
 
-# Create bounding boxes
-bounding_boxes_256 = []
-for lat in lats_256:
-    for lon in lons_256:
-        bounding_boxes_256.append((lon, lat, lon + lon_step_256, lat + lat_step_256))
+def BuildGrid(bounds, step):
+    """Builds the boxes of a regular grid over the bounds with vectorized operations."""
+    west, south, east, north = bounds
+    lons, lats = np.meshgrid(np.arange(west, east, step), np.arange(south, north, step))
+    minLon, minLat = lons.ravel(), lats.ravel()
+    return np.column_stack([minLon, minLat, minLon + step, minLat + step])
 
-# Convert to DataFrame
-df_boxes_256 = pd.DataFrame(bounding_boxes_256, columns=["min_lon", "min_lat", "max_lon", "max_lat"])
 
-# Load Denmark's boundary shapefile
-denmark_gdf = gpd.read_file("../../Shapefiles/Denmark_shapefile/dk_1km.shp")
-# Ensures it is in EPSG 4326
-denmark_gdf = denmark_gdf.to_crs("EPSG:4326")
+def FieldCoverage(boxBounds, fieldTree, fieldGeometries):
+    """Returns the number of fields and the fraction of the area covered by fields for every box."""
+    boxes = shapely.box(boxBounds[:, 0], boxBounds[:, 1], boxBounds[:, 2], boxBounds[:, 3])
+    boxIndex, fieldIndex = fieldTree.query(boxes, predicate="intersects")
+    fieldCount = np.bincount(boxIndex, minlength=len(boxes))
+    coveredArea = np.bincount(
+        boxIndex,
+        weights=shapely.area(shapely.intersection(boxes[boxIndex], fieldGeometries[fieldIndex])),
+        minlength=len(boxes)
+    )
+    return fieldCount, coveredArea / shapely.area(boxes)
 
-# Convert bounding boxes to geometries
-df_boxes_256["geometry"] = df_boxes_256.apply(
-    lambda row: box(row["min_lon"], row["min_lat"], row["max_lon"], row["max_lat"]), axis=1
-)
 
-# Convert to GeoDataFrame
-gdf_boxes_256 = gpd.GeoDataFrame(df_boxes_256, geometry="geometry", crs="EPSG:4326")
+def SplitBoxes(boxBounds):
+    """Splits every box into its four quadrants."""
+    minLon, minLat, maxLon, maxLat = boxBounds.T
+    midLon, midLat = (minLon + maxLon) / 2, (minLat + maxLat) / 2
+    return np.concatenate([
+        np.column_stack([minLon, minLat, midLon, midLat]),
+        np.column_stack([midLon, minLat, maxLon, midLat]),
+        np.column_stack([minLon, midLat, midLon, maxLat]),
+        np.column_stack([midLon, midLat, maxLon, maxLat]),
+    ])
 
-# Spatial join to keep only boxes that intersect Denmark
-gdf_filtered = gdf_boxes_256[gdf_boxes_256.intersects(denmark_gdf.geometry.union_all())]
 
-# Drop geometry column for CSV output
-df_filtered_boxes_256 = gdf_filtered.drop(columns=["geometry"])
+def AdaptiveGrid(fieldGeometries, bounds=DENMARK_BOUNDS, step=BASE_STEP, maxDepth=3, minDensity=0.2, maxFields=2000):
+    """
+    Builds a quadtree of download boxes over the fields.
+    Boxes without fields are dropped. A box is split into quadrants while it is mostly empty, so the empty
+    quadrants can be dropped, or while it holds more than maxFields fields, until it is maxDepth levels deep.
+    Returns the kept box bounds and their field counts.
+    """
+    fieldTree = shapely.STRtree(fieldGeometries)
+    boxBounds = BuildGrid(bounds, step)
+    keptBounds, keptCounts = [], []
+    for depth in range(maxDepth + 1):
+        fieldCount, density = FieldCoverage(boxBounds, fieldTree, fieldGeometries)
+        occupied = fieldCount > 0
+        boxBounds, fieldCount, density = boxBounds[occupied], fieldCount[occupied], density[occupied]
 
-print(gdf_filtered.head())
-print(len(gdf_filtered), "bounding boxes intersect Denmark.")
+        split = (density < minDensity) | (fieldCount > maxFields)
+        if depth == maxDepth:
+            split[:] = False
+        keptBounds.append(boxBounds[~split])
+        keptCounts.append(fieldCount[~split])
+        logging.info(f"Depth {depth}: kept {np.count_nonzero(~split)} boxes and split {np.count_nonzero(split)}")
+        if not split.any():
+            break
+        boxBounds = SplitBoxes(boxBounds[split])
 
-# Save to CSV file
-csv_filename = "../../Shapefiles/CSV/denmarkBB.csv"
-df_filtered_boxes_256.to_csv(csv_filename, index=False)
+    return np.concatenate(keptBounds), np.concatenate(keptCounts)
 
-print(f"CSV file '{csv_filename}' has been created successfully.")
\ No newline at end of file
+
+def ExpectedPixels(boxBounds, gsd=10.0):
+    """Number of pixels a box covers at the ground sampling distance."""
+    minLon, minLat, maxLon, maxLat = boxBounds.T
+    widthMeters = (maxLon - minLon) * METERS_PER_DEGREE * np.cos(np.radians((minLat + maxLat) / 2))
+    heightMeters = (maxLat - minLat) * METERS_PER_DEGREE
+    return (np.ceil(widthMeters / gsd) * np.ceil(heightMeters / gsd)).astype(np.int64)
+
+
+def LoadFieldGeometries(fieldsFile):
+    """Loads the field polygons from a file, or from the Field table when no file is given."""
+    if fieldsFile is not None:
+        return gpd.read_file(fieldsFile).to_crs("EPSG:4326").geometry.values
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from Database.SQLHandler import SQLHandler
+
+    dotenv.load_dotenv(dotenv.find_dotenv())
+    db_handler = SQLHandler(
+        host=os.getenv("SQLHOST"),
+        user=os.getenv("DBUSER"),
+        password=os.getenv("DBPASSWORD"),
+        database=os.getenv("DBDB")
+    )
+    return shapely.from_wkt(list(db_handler.getAllFieldPolygons().values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate download bounding boxes that only cover area with fields.")
+    parser.add_argument("--fields", default=None, help="File with the field polygons, the Field table is used when left out")
+    parser.add_argument("--bounds", nargs=4, type=float, default=DENMARK_BOUNDS, metavar=("WEST", "SOUTH", "EAST", "NORTH"), help="Area to cover in EPSG:4326")
+    parser.add_argument("--max-depth", type=int, default=3, help="How many times a box can be split into quadrants")
+    parser.add_argument("--min-density", type=float, default=0.2, help="Boxes where fields cover less of the area than this are split")
+    parser.add_argument("--max-fields", type=int, default=2000, help="Boxes with more fields than this are split")
+    parser.add_argument("--output", default="../../Shapefiles/CSV/denmarkBB.csv", help="CSV file to write")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    fieldGeometries = LoadFieldGeometries(args.fields)
+    boxBounds, fieldCounts = AdaptiveGrid(
+        fieldGeometries,
+        bounds=tuple(args.bounds),
+        maxDepth=args.max_depth,
+        minDensity=args.min_density,
+        maxFields=args.max_fields
+    )
+
+    df_boxes = pd.DataFrame(boxBounds, columns=["min_lon", "min_lat", "max_lon", "max_lat"])
+    df_boxes.insert(0, "ID", np.arange(1, len(df_boxes) + 1))
+    df_boxes["fields"] = fieldCounts
+    df_boxes["expected_pixels"] = ExpectedPixels(boxBounds)
+
+    print(df_boxes.head())
+    print(f"{len(df_boxes)} bounding boxes cover {len(fieldGeometries)} fields with {df_boxes['expected_pixels'].sum()} pixels at 10 meters.")
+
+    df_boxes.to_csv(args.output, index=False)
+    print(f"CSV file '{args.output}' has been created successfully.")
+
+
+if __name__ == "__main__":
+    main()
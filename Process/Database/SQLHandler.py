@@ -85,6 +85,25 @@ class SQLHandler:
             logging.error(f"Error inserting data: {err}")
             raise
 
+    def insertSimpleDataPointsForFields(self, ListOfRows):
+        """Inserts the data points of many fields in one batch, the rows are in the order of insertSimpleDataPointsForAfield."""
+        try:
+            insert_query = """
+            INSERT INTO ndvi_data (FieldId,CropId,collection_date, BBID,
+            AverageRed, MedianRed, STDRed, MinRed, MaxRed,
+            AverageNir,MedianNir, STDNir, MinNir, MaxNir,
+            AverageNdvi,MedianNdvi, STDNdvi, MinNdvi, MaxNdvi)
+            VALUES (%s,%s, %s, %s,
+            %s, %s, %s, %s,%s,
+            %s, %s, %s, %s,%s,
+            %s, %s, %s, %s,%s)
+            """
+            self.cursor.executemany(insert_query,ListOfRows)
+            self.connection.commit()
+        except mysql.connector.Error as err:
+            logging.error(f"Error inserting data: {err}")
+            raise
+
     def getAllPolygonsBasedOnYearAndCropType(self, year: int, cropid: int) -> gpd.GeoDataFrame:
         try:
             get_query = """
@@ -1,14 +1,24 @@
 import pika
 import subprocess
 import re
+import os
 import sys
 import logging
 import argparse
+import multiprocessing
 import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 
-DATEPATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}\|\d{4}-\d{2}-\d{2}\|\d{1,2}\|\w*$")
+DATEPATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}\|\d{4}-\d{2}-\d{2}\|\d{1,2}\|\w*(\|(Tile|Field))?$")
 log_filename = "tiff_process.log"
 
+# Pre-forked pool of warm TIFF processes, None when every message gets its own subprocess
+process_pool = None
+pool_size = 1
+
+# Database connection of a pool process, made once by the initializer
+pool_db_handler = None
+
 def setup_logging(log_filename):
     logging.basicConfig(
         filename=log_filename,
@@ -28,6 +38,75 @@ def process_tiff(message, log_filename):
     )
     return process.wait()
 
+def init_pool_process(log_filename):
+    """Runs once in every pool process, imports the TIFF processing modules and connects to the database."""
+    global pool_db_handler
+    import TiffProcessor
+
+    # Log to the same file the TiffProcessor subprocess used
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+    TiffProcessor.setup_logging(f"ProcessFor{log_filename}")
+    TiffProcessor.workername = os.path.splitext(log_filename)[0]
+    pool_db_handler = TiffProcessor.CreateDbHandler()
+
+def warm_up_pool_process():
+    return os.getpid()
+
+def process_tiff_in_pool(message):
+    """Runs one message in a pool process and returns the exit code the TiffProcessor subprocess would have used."""
+    import TiffProcessor
+    from datetime import datetime
+
+    logging.info(f"Received MessagesData: {message}")
+    try:
+        start_str, end_str, CropID, saveTiff, statsMode = TiffProcessor.validate_message_data(message)
+        if pool_db_handler.connection is None or not pool_db_handler.connection.is_connected():
+            logging.warning("Database connection of the pool process was lost, reconnecting...")
+            pool_db_handler.connect()
+            if pool_db_handler.connection is None:
+                return 2
+
+        start_date = datetime.strptime(start_str, "%Y-%m-%d")
+        end_date = datetime.strptime(end_str, "%Y-%m-%d")
+        TiffProcessor.ProcessTiff(start_date, end_date, CropID, saveTiff, statsMode, db_handler=pool_db_handler)
+        return 0
+    except SystemExit as e:
+        # validate_message_data exits with 1 for messages that can not be processed
+        return e.code if isinstance(e.code, int) else 2
+    except Exception as e:
+        logging.exception(f"TIFF processing failed: {e}")
+        return 2
+
+def create_process_pool(processes):
+    """
+    Forks the pool processes and waits for them to be warm.
+    The pool is forked before the RabbitMQ connection is opened, so the children do not inherit its socket.
+    """
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=init_pool_process,
+        initargs=(log_filename,)
+    )
+    # With fork every process is started on the first submit
+    pool.submit(warm_up_pool_process).result()
+    logging.info(f"Started a pool of {processes} TIFF processes")
+    return pool
+
+def submit_tiff(message, executor):
+    """Dispatches a message to the pool, or to a new subprocess when there is no pool."""
+    global process_pool
+    if process_pool is None:
+        return executor.submit(process_tiff, message, log_filename)
+    try:
+        return process_pool.submit(process_tiff_in_pool, message)
+    except BrokenProcessPool:
+        logging.error("The TIFF process pool is broken, starting a new one")
+        process_pool.shutdown(wait=False, cancel_futures=True)
+        process_pool = create_process_pool(pool_size)
+        return process_pool.submit(process_tiff_in_pool, message)
+
 def callback(ch, method, properties, body, executor):
     message = body.decode().strip()
     logging.info(f"Received message: {message}")
@@ -37,7 +116,7 @@ def callback(ch, method, properties, body, executor):
         ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
         return
 
-    future = executor.submit(process_tiff, message, log_filename)
+    future = submit_tiff(message, executor)
 
     def on_done(f):
         try:
@@ -57,13 +136,23 @@ def callback(ch, method, properties, body, executor):
 
     future.add_done_callback(lambda f: ch.connection.add_callback_threadsafe(lambda: on_done(f)))
 
-def consume():
+def consume(processes=1, use_pool=False):
+    """
+    Consumes TIFF messages with a number of parallel slots.
+    :param processes: Number of messages processed at the same time, the prefetch count matches it.
+    :param use_pool: Run the messages in a pre-forked pool of warm processes instead of a subprocess per message.
+    """
+    global process_pool, pool_size
+    pool_size = processes
+    if use_pool:
+        process_pool = create_process_pool(processes)
+
     connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost', heartbeat=30))
     channel = connection.channel()
     channel.queue_declare(queue='Process_task_queue', durable=True)
-    channel.basic_qos(prefetch_count=1)
+    channel.basic_qos(prefetch_count=processes)
 
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=processes)
     channel.basic_consume(queue='Process_task_queue', on_message_callback=lambda ch, method, properties, body: callback(ch, method, properties, body, executor))
 
     logging.info("TIFF RabbitMQ consumer started.")
@@ -75,16 +164,22 @@ def consume():
         channel.stop_consuming()
         connection.close()
         executor.shutdown(wait=False)
+        if process_pool is not None:
+            process_pool.shutdown(wait=False, cancel_futures=True)
         logging.info("Graceful shutdown.")
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("LogFile", nargs="?", default="tiff_process.log", help="Log file name")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("ProcessWorkerProcesses", os.cpu_count() or 1)), help="Number of messages processed in parallel (default: number of cores)")
+    parser.add_argument("--subprocess", action="store_true", help="Start a TiffProcessor subprocess per message instead of using the pre-forked pool")
     args = parser.parse_args()
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
     global log_filename
     log_filename = f"{args.LogFile}.log"
     setup_logging(log_filename)
-    consume()
+    consume(processes=args.processes, use_pool=not args.subprocess)
 
 if __name__ == "__main__":
     main()
@@ -2,6 +2,7 @@ import logging, os, dotenv, sys, re, argparse
 from datetime import datetime, timedelta
 from ToDB.Todb import ToDb 
 from ToDB.TiffIntersector import TiffIntersector
+from ToDB.ZonalStatistics import ZonalStatistics
 from Database.SQLHandler import SQLHandler
 
 workername = ""
@@ -16,29 +17,44 @@ def setup_logging(log_file="Process.log"):
     logging.info(f"Logging initialized. Writing to {log_file}")
 
 def validate_message_data(message_data):
-    DATEPATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}\|\d{4}-\d{2}-\d{2}\|\d{1,2}\|\w*$")
+    DATEPATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}\|\d{4}-\d{2}-\d{2}\|\d{1,2}\|\w*(\|(Tile|Field))?$")
     if not DATEPATTERN.match(message_data):
         logging.error(f"Invalid MessagesData format: {message_data}")
         sys.exit(1)
-    return message_data.split("|")
+    MessageParts = message_data.split("|")
+    # The statistics mode is optional, tile-major unless the message asks for field-major
+    if len(MessageParts) == 4:
+        MessageParts.append("Tile")
+    return MessageParts
 
 def daterange(start_date, end_date):
     for n in range((end_date - start_date).days + 1):
         yield start_date + timedelta(n)
 
-def ProcessTiff(start_date, end_date,CropId,saveTiff):
-    logging.info(f"Starting TIFF Processing from {start_date} to {end_date} with crop id:{CropId}")
-    
+def CreateDbHandler():
+    """Connects to the database configured in the .env file."""
     dotenvFile = dotenv.find_dotenv()
     dotenv.load_dotenv(dotenvFile)
 
-    db_handler = SQLHandler(
+    return SQLHandler(
         host=os.getenv("SQLHOST"),
         user=os.getenv("DBUSER"),
         password=os.getenv("DBPASSWORD"),
         database=os.getenv("DBDB")
     )
 
+def ProcessTiff(start_date, end_date,CropId,saveTiff,statsMode="Tile",db_handler=None):
+    """
+    Processes the TIFFs of every day in the date range into data points for the fields of the crop type.
+    :param statsMode: Tile reads every tile of a date once for all its fields, Field masks the tiles once per field.
+        Fields spanning several tiles and runs that save the field TIFFs always use Field.
+    :param db_handler: Existing database connection, a new one is made when left out.
+    """
+    logging.info(f"Starting TIFF Processing from {start_date} to {end_date} with crop id:{CropId} and {statsMode} statistics")
+
+    if db_handler is None:
+        db_handler = CreateDbHandler()
+
     tiff_root = "../Download/Pictures"
 
     for date in daterange(start_date, end_date):
@@ -48,11 +64,15 @@ def ProcessTiff(start_date, end_date,CropId,saveTiff):
         os.makedirs(output_folder, exist_ok=True)
 
         try:
-            intersector = TiffIntersector(db_handler, tiff_root)
+            # Dates downloaded with several band sets use Raw unless ProcessBandSet picks one
+            intersector = TiffIntersector(db_handler, tiff_root, band_set=os.getenv("ProcessBandSet") or None)
             to_db = ToDb(db_handler, intersector)
             polygons = db_handler.getAllPolygonsBasedOnYearAndCropType(year=year,cropid=CropId)
 
             if polygons is not None and not polygons.empty:
+                if statsMode == "Tile" and saveTiff != "True":
+                    # Only the fields the tile-major statistics could not handle are processed field by field
+                    polygons = ZonalStatistics(db_handler, intersector).InsertDateIntoDataBase(polygons, CropId, DateStr)
                 for _, row in polygons.iterrows():
                     polygon = row["geometry"]
                     field_id = row["FieldId"]
@@ -65,7 +85,10 @@ def ProcessTiff(start_date, end_date,CropId,saveTiff):
 
                     if intersections:
                         logging.info(f"Processing Field ID {field_id} from {tiff_root} for {DateStr}.")
-                        to_db.InsertAveragePointsIntoDataBase(intersections, field_id, CropId ,DateStr, polygon, output_tiff)
+                        try:
+                            to_db.InsertAveragePointsIntoDataBase(intersections, field_id, CropId ,DateStr, polygon, output_tiff)
+                        finally:
+                            intersector.release_tiff(intersections)
                     else:
                         logging.debug(f"No intersecting TIFFs for Field ID {field_id} on {DateStr} in {tiff_root}.")
             else:
@@ -77,7 +100,7 @@ def ProcessTiff(start_date, end_date,CropId,saveTiff):
 
 def main():
     parser = argparse.ArgumentParser(description="Process TIFFs into NDVI data.")
-    parser.add_argument("MessagesData", help="Data in format YYYY-MM-DD|yyyy-MM-DD|CropId")
+    parser.add_argument("MessagesData", help="Data in format YYYY-MM-DD|yyyy-MM-DD|CropId|SaveTiff[|Tile|Field]")
     parser.add_argument("LogFile", nargs="?", default="tiff_process.log", help="Log file name")
 
     args = parser.parse_args()
@@ -89,10 +112,10 @@ def main():
         workername = match.group(1)
 
     logging.info(f"Received MessagesData: {args.MessagesData}")
-    start_str, end_str, CropID, saveTiff = validate_message_data(args.MessagesData)
+    start_str, end_str, CropID, saveTiff, statsMode = validate_message_data(args.MessagesData)
     start_date = datetime.strptime(start_str, "%Y-%m-%d")
     end_date = datetime.strptime(end_str, "%Y-%m-%d")
-    ProcessTiff(start_date, end_date,CropID, saveTiff)
+    ProcessTiff(start_date, end_date,CropID, saveTiff, statsMode)
 
 if __name__ == "__main__":
     main()
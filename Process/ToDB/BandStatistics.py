@@ -0,0 +1,45 @@
+import numpy as np
+
+# Bins of the histograms, the numpy default the statistics have always used
+HISTOGRAM_BINS = 10
+
+
+def BandStatistics(values, bins=HISTOGRAM_BINS):
+    """
+    Mean, median, std, min, max and density histogram of the valid pixel values of one band.
+    The moments are reduced in float64, the median comes from one partition instead of a sort,
+    and the histogram is binned over the extremes that are already known.
+    :param values: One dimensional array of the valid pixels, at least one value.
+    Returns a dictionary with mean, median, std, min, max as floats and hist and bins as lists.
+    """
+    count = values.size
+    mean = values.sum(dtype=np.float64) / count
+    deviations = values.astype(np.float64)
+    deviations -= mean
+    std = np.sqrt(np.dot(deviations, deviations) / count)
+    minimum = values.min()
+    maximum = values.max()
+
+    # The two middle values are put in place by one partition instead of sorting
+    lowMiddle, highMiddle = (count - 1) // 2, count // 2
+    middle = np.partition(values, (lowMiddle, highMiddle))
+    median = (float(middle[lowMiddle]) + float(middle[highMiddle])) / 2
+
+    # With the range given numpy does not look for the extremes again
+    hist, edges = np.histogram(values, bins=bins, range=(float(minimum), float(maximum)), density=True)
+    return {
+        "mean": float(mean),
+        "median": median,
+        "std": float(std),
+        "min": float(minimum),
+        "max": float(maximum),
+        "hist": hist.tolist(),
+        "bins": edges.tolist(),
+    }
+
+
+def StatisticsRow(stats):
+    """Average, median, std, min and max in the column order of ndvi_data, None for a band that is missing."""
+    if stats is None:
+        return [None] * 5
+    return [stats[name] for name in ("mean", "median", "std", "min", "max")]
@@ -1,57 +1,226 @@
 import os
+import sqlite3
+import tempfile
 import mysql.connector
 import geopandas as gpd
+import shapely
 from rasterio.merge import merge
+from rasterio.warp import transform_bounds
 from shapely.geometry import box
 from shapely import wkt
 import rasterio
 import logging
 
 TIFF_ROOT = "../Download/Pictures"
+MERGED_TIFF_FOLDER = "../tempMergedTiff"
+# Band sets of the downloads in the order they are preferred when a date has several
+BAND_SETS = ("Raw", "Ndvi")
 
 class TiffIntersector:
-    def __init__(self, SqlHandler, tiff_root):
+    def __init__(self, SqlHandler, tiff_root, manifest_file=None, band_set=None):
+        """
+        :param tiff_root: Folder of the downloaded pictures.
+        :param manifest_file: Download manifest, defaults to manifest.sqlite in the tiff root.
+        :param band_set: Band set of the rasters to use, Raw or Ndvi. When left out Raw is used on dates that have it, else Ndvi.
+        """
         self.SqlHandler = SqlHandler
         self.TIFF_ROOT = tiff_root
+        self.BandSet = band_set
+        self.ManifestFile = manifest_file if manifest_file is not None else os.path.join(tiff_root, "manifest.sqlite")
+        # Paths in the manifest are relative to the Download folder the pictures folder is in
+        self.DownloadRoot = os.path.dirname(os.path.normpath(tiff_root))
+        # Per date spatial index of the raster catalog, (STRtree of the raster bounds, raster paths)
+        self.catalogs = {}
+        # Temporary merges made by this intersector, removed by release_tiff
+        self.mergedPaths = set()
+        # Field or box id of every TIFF path looked up so far, filled for the rasters of a date by load_catalog
+        self.boundingBoxIds = {}
+
+    def get_bounding_box_id(self, tiff_path):
+        """
+        Returns the id of the field or box a TIFF was downloaded for.
+        Raster store files are named by their store key and looked up in the download manifest,
+        the older per worker folders are named FieldId{id}.
+        The ids of the rasters in a loaded catalog are already known, other paths are looked up once.
+        """
+        if tiff_path in self.boundingBoxIds:
+            return self.boundingBoxIds[tiff_path]
 
+        row = None
+        # Temporary merges are not in the manifest
+        if tiff_path not in self.mergedPaths and os.path.exists(self.ManifestFile):
+            name = os.path.splitext(os.path.basename(tiff_path))[0]
+            connection = sqlite3.connect(f"file:{self.ManifestFile}?mode=ro", uri=True, timeout=30)
+            try:
+                row = connection.execute(
+                    "SELECT FieldId FROM Downloads WHERE StoreKey = ? ORDER BY CompletedAt LIMIT 1",
+                    (name,)
+                ).fetchone()
+            except sqlite3.OperationalError:
+                row = None
+            finally:
+                connection.close()
+        BBid = row[0] if row is not None else folder_bounding_box_id(tiff_path)
+        if tiff_path not in self.mergedPaths:
+            self.boundingBoxIds[tiff_path] = BBid
+        return BBid
+
+
+    def load_catalog(self, date):
+        """
+        Builds the spatial index of the rasters downloaded for a date from the raster catalog in the download manifest.
+        Rasters downloaded before the catalog existed are opened once to read their bounds.
+        Returns (STRtree of the raster bounds in EPSG:4326, raster paths), or None when there is no manifest.
+        """
+        if date in self.catalogs:
+            return self.catalogs[date]
+        if not os.path.exists(self.ManifestFile):
+            return None
+
+        connection = sqlite3.connect(f"file:{self.ManifestFile}?mode=ro", uri=True, timeout=30)
+        try:
+            rasterColumns = {row[1] for row in connection.execute("PRAGMA table_info(Rasters)")}
+            if rasterColumns:
+                bandSetColumn = "Rasters.BandSet" if "BandSet" in rasterColumns else "NULL"
+                rows = connection.execute(
+                    f"""
+                    SELECT DISTINCT Downloads.Path, Downloads.Resolution, {bandSetColumn},
+                        Rasters.MinLon, Rasters.MinLat, Rasters.MaxLon, Rasters.MaxLat
+                    FROM Downloads LEFT JOIN Rasters ON Rasters.Path = Downloads.Path
+                    WHERE Downloads.Date = ? AND Downloads.Path != ''
+                    """,
+                    (date,)
+                ).fetchall()
+            else:
+                # Manifest from before the raster catalog, without the Rasters table
+                rows = [(row[0], row[1], None, None, None, None, None) for row in connection.execute(
+                    "SELECT DISTINCT Path, Resolution FROM Downloads WHERE Date = ? AND Path != ''", (date,)
+                )]
+            # The first field or box a raster store key was downloaded for, store keys include the date
+            try:
+                storeKeyIds = {}
+                for StoreKey, FieldId in connection.execute(
+                    "SELECT StoreKey, FieldId FROM Downloads WHERE Date = ? AND StoreKey IS NOT NULL ORDER BY CompletedAt DESC",
+                    (date,)
+                ):
+                    storeKeyIds[StoreKey] = FieldId
+            except sqlite3.OperationalError:
+                # Manifest from before the raster store
+                storeKeyIds = {}
+        finally:
+            connection.close()
+
+        rasters = {}
+        uncataloged = 0
+        for path, Resolution, BandSet, MinLon, MinLat, MaxLon, MaxLat in rows:
+            tiff_path = os.path.join(self.DownloadRoot, path)
+            if tiff_path in rasters or not os.path.exists(tiff_path):
+                continue
+            if BandSet is None:
+                # Downloads of other band sets than Raw are recorded under the resolution with the band set appended
+                BandSet = Resolution.rsplit("_", 1)[1] if "_" in Resolution else "Raw"
+            if MinLon is None:
+                uncataloged += 1
+                with rasterio.open(tiff_path) as src:
+                    MinLon, MinLat, MaxLon, MaxLat = transform_bounds(src.crs or "EPSG:4326", "EPSG:4326", *src.bounds)
+            rasters[tiff_path] = (BandSet, (MinLon, MinLat, MaxLon, MaxLat))
+
+        if uncataloged:
+            logging.info(f"Read the bounds of {uncataloged} rasters on {date} that are not in the raster catalog")
+        BandSet = self.choose_band_set({bandSet for bandSet, _ in rasters.values()}, date)
+        paths = [path for path, (bandSet, _) in rasters.items() if bandSet == BandSet]
+        bounds = [rasters[path][1] for path in paths]
+        for path in paths:
+            FieldId = storeKeyIds.get(os.path.splitext(os.path.basename(path))[0])
+            self.boundingBoxIds[path] = FieldId if FieldId is not None else folder_bounding_box_id(path)
+        tree = shapely.STRtree(shapely.box(*zip(*bounds)) if bounds else [])
+        self.catalogs[date] = (tree, paths)
+        logging.info(f"Loaded {len(paths)} {BandSet} rasters on {date} from the raster catalog")
+        return self.catalogs[date]
+
+    def choose_band_set(self, band_sets, date):
+        """
+        Returns the band set of the rasters used on a date, the band set of the intersector or the first of BAND_SETS the date has.
+        Rasters of different band sets have different bands and types, so only one band set is used per date.
+        """
+        BandSet = self.BandSet
+        if BandSet is None:
+            BandSet = next((bandSet for bandSet in BAND_SETS if bandSet in band_sets), None)
+        ignored = sorted(bandSet for bandSet in band_sets if bandSet != BandSet)
+        if ignored:
+            logging.info(f"Using the {BandSet} rasters on {date}, ignoring the {', '.join(ignored)} rasters")
+        return BandSet
 
     def find_intersecting_tiffs(self, polygon, date):
         """
         Finds TIFF files that intersect with a given polygon for a given date.
+        The rasters are looked up in the raster catalog of the download manifest, the pictures folder is only walked without a manifest.
         If multiple TIFF files intersect with a polygon, merge them into one.
         """
         try:
-            intersecting_tiffs = []
+            if isinstance(polygon, gpd.GeoSeries):
+                polygon = polygon.iloc[0]
 
-            for root, _, files in os.walk(self.TIFF_ROOT):
-                for file in files:
-                    if file.endswith(".tiff") and date in file:
-                        tiff_path = os.path.join(root, file)
-                        with rasterio.open(tiff_path) as src:
-                            tiff_geom = box(*src.bounds)
+            catalog = self.load_catalog(date)
+            if catalog is not None:
+                tree, paths = catalog
+                intersecting_tiffs = [paths[index] for index in sorted(tree.query(polygon, predicate="intersects"))]
+            else:
+                intersecting_tiffs = self.walk_intersecting_tiffs(polygon, date)
+            return self.merge_tiffs(intersecting_tiffs, date)
 
-                            if isinstance(polygon, gpd.GeoSeries):
-                                poly = polygon.iloc[0]
-                            else:
-                                poly = polygon
+        except Exception as e:
+            logging.error(f"Failed to create intersections correctly maybe? : {e}")
+            return None
+
+    def walk_intersecting_tiffs(self, polygon, date):
+        """
+        Finds the TIFF files of the date that intersect the polygon by opening every TIFF in the pictures folder.
+        The band set of every TIFF is told from its bands, only the TIFFs of the band set chosen for the date are returned.
+        """
+        intersecting_tiffs = []
+        band_sets = set()
 
-                            poly_proj = gpd.GeoSeries([poly], crs="EPSG:4326").to_crs(src.crs).iloc[0]
+        for root, _, files in os.walk(self.TIFF_ROOT):
+            for file in files:
+                # Raster store files are in a folder per date, the older per worker folders have the date in the file name
+                if file.endswith(".tiff") and (date in file or date in root.split(os.sep)):
+                    tiff_path = os.path.join(root, file)
+                    with rasterio.open(tiff_path) as src:
+                        BandSet = raster_band_set(src)
+                        band_sets.add(BandSet)
+                        tiff_geom = box(*src.bounds)
 
-                            if poly_proj.intersects(tiff_geom):
-                                intersecting_tiffs.append(tiff_path)
+                        poly_proj = gpd.GeoSeries([polygon], crs="EPSG:4326").to_crs(src.crs).iloc[0]
 
-            #logging.info(f"Polygon intersects {len(intersecting_tiffs)} TIFFs on {date}. Array: {intersecting_tiffs}")
-            #logging.info(polygon)
+                        if poly_proj.intersects(tiff_geom):
+                            intersecting_tiffs.append((tiff_path, BandSet))
 
-            if len(intersecting_tiffs) == 1:
-                return intersecting_tiffs[0]
+        #logging.info(f"Polygon intersects {len(intersecting_tiffs)} TIFFs on {date}. Array: {intersecting_tiffs}")
+        #logging.info(polygon)
+        BandSet = self.choose_band_set(band_sets, date)
+        return [tiff_path for tiff_path, bandSet in intersecting_tiffs if bandSet == BandSet]
 
-            if len(intersecting_tiffs) > 1:
-                merged_path = f"../tempMergedTiff/merged_{date}.tiff"
-                os.makedirs(os.path.dirname(merged_path), exist_ok=True)
+    def merge_tiffs(self, intersecting_tiffs, date):
+        """
+        Returns the only TIFF, a merge of the TIFFs when there are several, or None when there are none.
+        Every merge gets its own temporary file, so processes working on the same date do not overwrite each other,
+        hand it to release_tiff once it has been read.
+        """
+        if len(intersecting_tiffs) == 1:
+            return intersecting_tiffs[0]
 
-                src_files_to_merge = [rasterio.open(tiff) for tiff in intersecting_tiffs]
+        if len(intersecting_tiffs) > 1:
+            os.makedirs(MERGED_TIFF_FOLDER, exist_ok=True)
+            handle, merged_path = tempfile.mkstemp(prefix=f"merged_{date}_{os.getpid()}_", suffix=".tiff", dir=MERGED_TIFF_FOLDER)
+            os.close(handle)
+            self.mergedPaths.add(merged_path)
 
+            src_files_to_merge = [rasterio.open(tiff) for tiff in intersecting_tiffs]
+            try:
+                layouts = {(src.count, src.dtypes) for src in src_files_to_merge}
+                if len(layouts) > 1:
+                    raise ValueError(f"Can not merge TIFFs with different bands on {date}: {sorted(layouts)}")
                 merged_array, merged_transform = merge(src_files_to_merge)
 
                 out_meta = src_files_to_merge[0].meta.copy()
@@ -64,15 +233,34 @@ class TiffIntersector:
 
                 with rasterio.open(merged_path, "w", **out_meta) as dest:
                     dest.write(merged_array)
-
+            except Exception:
+                self.release_tiff(merged_path)
+                raise
+            finally:
                 for src in src_files_to_merge:
                     src.close()
 
-                logging.info(f"Merged {len(intersecting_tiffs)} TIFFs into {merged_path}")
-                return merged_path
+            logging.info(f"Merged {len(intersecting_tiffs)} TIFFs into {merged_path}")
+            return merged_path
 
-            return None
+        return None
 
-        except Exception as e:
-            logging.error(f"Failed to create intersections correctly maybe? : {e}")
-            return None
\ No newline at end of file
+    def release_tiff(self, tiff_path):
+        """Removes a TIFF returned by find_intersecting_tiffs when it is a temporary merge, downloaded TIFFs are kept."""
+        if tiff_path in self.mergedPaths:
+            self.mergedPaths.discard(tiff_path)
+            try:
+                os.remove(tiff_path)
+            except FileNotFoundError:
+                pass
+
+
+def raster_band_set(src):
+    """Band set of an open raster told from its bands, Ndvi has the INT16 NDVI and mask bands, Raw the UINT16 Red, NIR and mask bands."""
+    return "Ndvi" if src.count == 2 and src.dtypes[0] == "int16" else "Raw"
+
+
+def folder_bounding_box_id(tiff_path):
+    """Id of a TIFF in the older per worker folders, which are named FieldId{id}."""
+    foldername = os.path.basename(os.path.dirname(tiff_path))
+    return foldername.replace("FieldId","")
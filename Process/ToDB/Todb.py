@@ -1,18 +1,27 @@
 import numpy as np
 import mysql.connector
-import rasterio, os, logging,json
+import rasterio, os, logging
 import matplotlib
 import geopandas as gpd
 from shapely import wkt
 from rasterio.mask import mask
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as copyRaster
+from ToDB.BandStatistics import BandStatistics, StatisticsRow
 matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
 
+# NDVI downloaded in the Ndvi band set is stored as INT16 NDVI times this scale
+NDVI_SCALE = 10000.0
+
 
 
 class ToDb:
     def __init__(self, SqlHandler, intersector):
         self.SqlHandler = SqlHandler
+        self.intersector = intersector
+        # Fields with a lower fraction of valid pixels inside their polygon are skipped
+        self.MinValidFraction = float(os.getenv("MinFieldValidFraction", 0.0))
 
     def InsertAveragePointsIntoDataBase(self, path, FieldID,CropId, Date, polygon, output_tiff):
         """Process a TIFF image: compute average NDVI & save a new TIFF with out_image_red, NIR, Mask, and NDVI"""
@@ -22,65 +31,50 @@ class ToDb:
             with rasterio.open(path) as src:
                 if src.crs != "EPSG:4326":
                     polygon = polygon.to_crs(src.crs)
-                foldername = os.path.basename(os.path.dirname(path))
-                BBid = foldername.replace("FieldId","")
+                BBid = self.intersector.get_bounding_box_id(path)
                 #out_image_red = src.read(1).astype(np.float32)
                 #out_image_nir = src.read(2).astype(np.float32) 
                 #DataMask = src.read(3)
 
                 # Mask data to the polygon
-                
-                out_images, out_transform = mask(src, [polygon], crop=True, filled=True, nodata=0, indexes=[1, 2, 3])
-
-                out_image_red = out_images[0].astype(np.float32)
-                out_image_nir = out_images[1].astype(np.float32)
-                out_image_dMask = out_images[2]
+                # Downloads in the Ndvi band set hold NDVI scaled by NDVI_SCALE as INT16 and a mask band instead of Red, NIR and mask
+                ndviInput = src.count == 2 and src.dtypes[0] == "int16"
+                # Unfilled, so the pixels outside the polygon can be told apart from the pixels without data
+                out_images, out_transform = mask(src, [polygon], crop=True, filled=False, indexes=[1, 2] if ndviInput else [1, 2, 3])
                 try:
                     while out_images is not None and out_images.size > 0:
-                        if out_image_red.max() > 1.0 or out_image_nir.max() > 1.0:
-                            out_image_red /= 65535.0
-                            out_image_nir /= 65535.0
-                        logging.info(f"Masked Red shape: {out_image_red.shape}, NIR shape: {out_image_nir.shape}, Mask shape: {out_image_dMask.shape}")
-                        valid_pixels = out_image_dMask == 1
-
-
-                        ndvi = np.full_like(out_image_red, np.nan, dtype=np.float32)
-                        ndvi[valid_pixels] = (out_image_nir[valid_pixels] - out_image_red[valid_pixels]) / (out_image_nir[valid_pixels] + out_image_red[valid_pixels] + 1e-10)
-                        #plt.hist(ndvi)
-                        #plt.title(f"Histogram of ndvi of field {FieldID} on the date {Date}")
-                        #plt.savefig(f"Histogram of ndvi of field {FieldID} on the date {Date}")
-                        #print(ndvi.max())
-                        #print(ndvi.min())
-                        
-                        averageRed = np.nanmean(out_image_red[valid_pixels]).item()
-                        MedianRed = np.nanmedian(out_image_red[valid_pixels]).item()
-                        StdRed = np.nanstd(out_image_red[valid_pixels]).item()
-                        MinRed = np.nanmin(out_image_red[valid_pixels]).item()
-                        MaxRed = np.nanmax(out_image_red[valid_pixels]).item()
-                        hist, bins = np.histogram(out_image_red[valid_pixels], density=True)
-                        HistJsonRed = json.dumps({"hist": hist.tolist(), "bins": bins.tolist()}) 
-
-                        averageNirRed = np.nanmean(out_image_nir[valid_pixels]).item()
-                        MedianNirRed = np.nanmedian(out_image_nir[valid_pixels]).item()
-                        StdNirRed = np.nanstd(out_image_nir[valid_pixels]).item()
-                        MinNirRed = np.nanmin(out_image_nir[valid_pixels]).item()
-                        MaxNirRed = np.nanmax(out_image_nir[valid_pixels]).item()
-                        hist, bins = np.histogram(out_image_nir[valid_pixels], density=True)
-                        HistJsonNir = json.dumps({"hist": hist.tolist(), "bins": bins.tolist()}) 
-
-                        averageNdvi = np.nanmean(ndvi).item()
-                        MedianNdvi = np.nanmedian(ndvi[valid_pixels]).item()
-                        StdNdvi = np.nanstd(ndvi[valid_pixels]).item()
-                        MinNdvi = np.nanmin(ndvi[valid_pixels]).item()
-                        MaxNdvi = np.nanmax(ndvi[valid_pixels]).item()
-                        hist, bins = np.histogram(ndvi[valid_pixels], density=True)
-                        HistJsonNdvi = json.dumps({"hist": hist.tolist(), "bins": bins.tolist()}) 
-
-
-                        data_to_insert = [FieldID, CropId,Date,BBid, 
-                                        averageRed,MedianRed,StdRed,MinRed,MaxRed, 
-                                        averageNirRed,MedianNirRed,StdNirRed,MinNirRed,MaxNirRed, 
-                                        averageNdvi,MedianNdvi,StdNdvi,MinNdvi,MaxNdvi]
+                        inside_pixels = ~np.ma.getmaskarray(out_images[-1])
+                        out_image_dMask = out_images.data[-1]
+                        valid_pixels = inside_pixels & (out_image_dMask == 1)
+                        valid_count = np.count_nonzero(valid_pixels)
+                        inside_count = np.count_nonzero(inside_pixels)
+                        if valid_count == 0 or valid_count < self.MinValidFraction * inside_count:
+                            logging.info(f"Field ID {FieldID} on {Date} has {valid_count} valid of {inside_count} pixels, skipping...")
+                            break
+
+                        # The valid pixels are extracted once and every statistic works on them
+                        if ndviInput:
+                            logging.info(f"Masked NDVI shape: {out_images[0].shape}, Mask shape: {out_image_dMask.shape}")
+                            valid_ndvi = out_images.data[0][valid_pixels] / np.float32(NDVI_SCALE)
+                            # Red and NIR are not downloaded in the Ndvi band set
+                            RedStats = NirStats = None
+                        else:
+                            valid_red = out_images.data[0][valid_pixels].astype(np.float32)
+                            valid_nir = out_images.data[1][valid_pixels].astype(np.float32)
+                            scale = 65535.0 if valid_red.max() > 1.0 or valid_nir.max() > 1.0 else 1.0
+                            if scale != 1.0:
+                                valid_red /= scale
+                                valid_nir /= scale
+                            logging.info(f"Masked Red shape: {out_images[0].shape}, {valid_count} valid pixels, Mask shape: {out_image_dMask.shape}")
+                            valid_ndvi = (valid_nir - valid_red) / (valid_nir + valid_red + 1e-10)
+                            RedStats = BandStatistics(valid_red)
+                            NirStats = BandStatistics(valid_nir)
+                        NdviStats = BandStatistics(valid_ndvi)
+
+                        data_to_insert = [FieldID, CropId,Date,BBid,
+                                        *StatisticsRow(RedStats),
+                                        *StatisticsRow(NirStats),
+                                        *StatisticsRow(NdviStats)]
                         logging.info(data_to_insert)
                         self.SqlHandler.insertSimpleDataPointsForAfield(data_to_insert)
                         logging.info(f"Inserted NDVI data for Field ID {FieldID} on {Date}.")
@@ -88,13 +82,28 @@ class ToDb:
 
                         if output_tiff != "None":
 
+                            ndvi = np.full(out_image_dMask.shape, np.nan, dtype=np.float32)
+                            ndvi[valid_pixels] = valid_ndvi
+                            dMask = np.where(inside_pixels, out_image_dMask, 0).astype(np.float32)
+                            if ndviInput:
+                                stacked_bands = np.stack([
+                                dMask,
+                                ndvi
+                                ])
+                            else:
+                                stacked_bands = np.stack([
+                                out_images[0].filled(0).astype(np.float32) / np.float32(scale),
+                                out_images[1].filled(0).astype(np.float32) / np.float32(scale),
+                                dMask,
+                                ndvi
+                                ])
                             out_meta = src.meta.copy()
                             out_meta.update({
                             "driver": "GTiff",
-                            "height": out_image_red.shape[0],
-                            "width": out_image_red.shape[1],
+                            "height": ndvi.shape[0],
+                            "width": ndvi.shape[1],
                             "transform": out_transform,
-                            "count": 4,
+                            "count": stacked_bands.shape[0],
                             "dtype": "float32"
                             })
 
@@ -103,16 +112,13 @@ class ToDb:
                             #out_image_nir, 
                             #DataMask.astype(np.float32), 
                             #ndvi])
-                            stacked_bands = np.stack([
-                            out_image_red, 
-                            out_image_nir, 
-                            out_image_dMask.astype(np.float32),
-                            ndvi
-                            ])
-                            with rasterio.open(output_tiff, "w", **out_meta) as dest:
-                                dest.write(stacked_bands)
-
-                            logging.info(f"New TIFF saved as {output_tiff} with out_image_red, NIR, DataMask, and NDVI.")
+                            # Written as a compressed COG with internal tiles and overviews
+                            with MemoryFile() as memfile:
+                                with memfile.open(**out_meta) as dest:
+                                    dest.write(stacked_bands)
+                                    copyRaster(dest, output_tiff, driver="COG", COMPRESS="DEFLATE", PREDICTOR="FLOATING_POINT", BLOCKSIZE=256, OVERVIEWS="AUTO")
+
+                            logging.info(f"New TIFF saved as {output_tiff} with {'DataMask and NDVI' if ndviInput else 'out_image_red, NIR, DataMask, and NDVI'}.")
                         break
                 except Exception as er:
                     logging.error(f" out_images is empty: {er}")
@@ -0,0 +1,174 @@
+import numpy as np
+import geopandas as gpd
+import rasterio
+import shapely
+import logging
+import os
+from rasterio.features import rasterize, geometry_window
+from ToDB.Todb import NDVI_SCALE
+from ToDB.BandStatistics import HISTOGRAM_BINS
+
+
+class ZonalStatistics:
+    def __init__(self, SqlHandler, intersector):
+        """
+        Tile-major statistics, every tile of a date is read once and the statistics of all the fields inside it are computed together.
+        :param intersector: TiffIntersector whose raster catalog gives the tiles of a date.
+        """
+        self.SqlHandler = SqlHandler
+        self.intersector = intersector
+        # Fields with a lower fraction of valid pixels inside their polygon are skipped, as in the field-major statistics
+        self.MinValidFraction = float(os.getenv("MinFieldValidFraction", 0.0))
+
+    def InsertDateIntoDataBase(self, polygons, CropId, Date):
+        """
+        Inserts the statistics of the fields that lie inside a single tile of the date.
+        :param polygons: GeoDataFrame with FieldId and geometry in EPSG:4326.
+        Returns the GeoDataFrame of the fields left for the field-major statistics, fields spanning several tiles or overlapping
+        another field, or every field when there is no raster catalog.
+        """
+        catalog = self.intersector.load_catalog(Date)
+        if catalog is None:
+            logging.info(f"No raster catalog for {Date}, every field is processed field-major")
+            return polygons
+        tree, paths = catalog
+
+        geometries = polygons.geometry.values
+        fieldIndexes, tileIndexes = tree.query(geometries, predicate="intersects")
+        tileCounts = np.bincount(fieldIndexes, minlength=len(polygons))
+
+        # Fields that share pixels can not be told apart in one label image
+        overlapping = np.zeros(len(polygons), dtype=bool)
+        fieldTree = shapely.STRtree(geometries)
+        left, right = fieldTree.query(geometries, predicate="intersects")
+        pairs = left < right
+        left, right = left[pairs], right[pairs]
+        if len(left):
+            shared = shapely.area(shapely.intersection(geometries[left], geometries[right])) > 0
+            overlapping[left[shared]] = True
+            overlapping[right[shared]] = True
+
+        singleTile = (tileCounts == 1) & ~overlapping
+        rows = []
+        for tileIndex in np.unique(tileIndexes[singleTile[fieldIndexes]]):
+            fields = fieldIndexes[(tileIndexes == tileIndex) & singleTile[fieldIndexes]]
+            rows.extend(self.tileStatistics(paths[tileIndex], polygons.iloc[fields], CropId, Date))
+
+        if rows:
+            self.SqlHandler.insertSimpleDataPointsForFields(rows)
+        fieldMajor = polygons[(tileCounts > 1) | ((tileCounts == 1) & overlapping)]
+        logging.info(
+            f"Inserted tile-major statistics of {len(rows)} fields on {Date}, {len(fieldMajor)} fields spanning several tiles "
+            f"or overlapping are left for the field-major statistics"
+        )
+        return fieldMajor
+
+    def tileStatistics(self, path, fields, CropId, Date):
+        """Returns the ndvi_data rows of the fields inside one tile, fields without valid pixels get no row."""
+        with rasterio.open(path) as src:
+            geometries = fields.geometry
+            if src.crs is not None and src.crs != "EPSG:4326":
+                geometries = gpd.GeoSeries(geometries.values, crs="EPSG:4326").to_crs(src.crs)
+
+            # Only the part of the tile covered by its fields is read, the same window rasterio.mask crops to
+            window = geometry_window(src, list(geometries))
+            transform = src.window_transform(window)
+            bands = src.read(window=window)
+            ndviInput = src.count == 2 and src.dtypes[0] == "int16"
+            BBid = self.intersector.get_bounding_box_id(path)
+
+        # Label 0 is outside every field, the pixel center rule matches rasterio.mask
+        labels = rasterize(
+            ((geometry, label) for label, geometry in enumerate(geometries, start=1)),
+            out_shape=bands.shape[1:],
+            transform=transform,
+            fill=0,
+            dtype="int32",
+        )
+        fieldCount = len(fields) + 1
+        insideCounts = np.bincount(labels.ravel(), minlength=fieldCount)
+        valid = (bands[-1] == 1) & (labels > 0)
+        labels = labels[valid]
+        if labels.size == 0:
+            logging.info(f"No valid pixels of the {len(fields)} fields in {path} on {Date}")
+            return []
+        counts = np.bincount(labels, minlength=fieldCount)
+
+        if ndviInput:
+            red = nir = None
+            ndvi = bands[0][valid] / np.float32(NDVI_SCALE)
+        else:
+            red = bands[0][valid].astype(np.float32)
+            nir = bands[1][valid].astype(np.float32)
+            # Digital numbers are scaled to reflectance per field, as the field-major statistics do
+            scale = np.ones(fieldCount, dtype=np.float32)
+            bandMax = np.maximum(segmentMax(red, labels, fieldCount), segmentMax(nir, labels, fieldCount))
+            scale[bandMax > 1.0] = 65535.0
+            red /= scale[labels]
+            nir /= scale[labels]
+            ndvi = (nir - red) / (nir + red + 1e-10)
+
+        redStats = SegmentStatistics(red, labels, counts) if red is not None else None
+        nirStats = SegmentStatistics(nir, labels, counts) if nir is not None else None
+        ndviStats = SegmentStatistics(ndvi, labels, counts)
+
+        rows = []
+        for label, FieldId in enumerate(fields["FieldId"], start=1):
+            if counts[label] == 0 or counts[label] < self.MinValidFraction * insideCounts[label]:
+                logging.debug(f"Field ID {FieldId} has {counts[label]} valid of {insideCounts[label]} pixels in {path} on {Date}, skipping...")
+                continue
+            rows.append([FieldId, CropId, Date, BBid,
+                         *statisticsRow(redStats, label),
+                         *statisticsRow(nirStats, label),
+                         *statisticsRow(ndviStats, label)])
+        return rows
+
+
+def segmentMax(values, labels, length):
+    result = np.full(length, -np.inf, dtype=np.float64)
+    np.maximum.at(result, labels, values)
+    return result
+
+
+def SegmentStatistics(values, labels, counts):
+    """
+    Mean, std, min, max, median and histogram of the values of every label in one pass over the sorted values.
+    Labels without values get NaN, there must be at least one value.
+    Returns a dictionary of arrays indexed by label, hist and bins hold a row of histogram densities and edges per label.
+    """
+    length = len(counts)
+    values = values.astype(np.float64)
+    safeCounts = np.maximum(counts, 1)
+    mean = np.bincount(labels, weights=values, minlength=length) / safeCounts
+    std = np.sqrt(np.bincount(labels, weights=(values - mean[labels]) ** 2, minlength=length) / safeCounts)
+
+    # Sorted by label and then value, every label is a contiguous segment
+    order = np.lexsort((values, labels))
+    sortedValues = values[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    present = counts > 0
+    lastIndex = len(sortedValues) - 1
+    minimum = np.where(present, sortedValues[np.clip(starts, 0, lastIndex)], np.nan)
+    maximum = np.where(present, sortedValues[np.clip(starts + counts - 1, 0, lastIndex)], np.nan)
+    lowMiddle = sortedValues[np.clip(starts + (counts - 1) // 2, 0, lastIndex)]
+    highMiddle = sortedValues[np.clip(starts + counts // 2, 0, lastIndex)]
+    median = np.where(present, (lowMiddle + highMiddle) / 2, np.nan)
+
+    # Histograms over the range of every label, a label with a single value gets the range value +- 0.5 like numpy
+    low = np.where(present, np.where(maximum > minimum, minimum, minimum - 0.5), 0.0)
+    high = np.where(present, np.where(maximum > minimum, maximum, minimum + 0.5), 1.0)
+    binWidth = (high - low) / HISTOGRAM_BINS
+    bins = np.floor((values - low[labels]) / binWidth[labels]).astype(np.int64)
+    bins = np.clip(bins, 0, HISTOGRAM_BINS - 1)
+    histCounts = np.bincount(labels * HISTOGRAM_BINS + bins, minlength=length * HISTOGRAM_BINS).reshape(length, HISTOGRAM_BINS)
+    density = histCounts / (safeCounts[:, None] * binWidth[:, None])
+    edges = low[:, None] + binWidth[:, None] * np.arange(HISTOGRAM_BINS + 1)
+
+    return {"mean": mean, "std": std, "min": minimum, "max": maximum, "median": median, "hist": density, "bins": edges}
+
+
+def statisticsRow(stats, label):
+    """Average, median, std, min and max of a label in the column order of ndvi_data, None when the band is missing."""
+    if stats is None:
+        return [None] * 5
+    return [stats[name][label].item() for name in ("mean", "median", "std", "min", "max")]
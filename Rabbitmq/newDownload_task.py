@@ -1,4 +1,4 @@
-import pika,sys,argparse
+import pika,sys,argparse,re
 import sys
 from datetime import datetime, timedelta
 
@@ -26,10 +26,14 @@ def split_date_range(start_date, end_date, workers, max_days=10):
     
     return final_chunks
 
-def distribute_tasks(start_date, end_date, workers, mode, region, resolution):
+def distribute_tasks(start_date, end_date, workers, mode, region, resolution, max_cloud=None, band_set="Raw"):
     """Distributes the tasks among workers while ensuring max 10-day chunks."""
     date_chunks = split_date_range(start_date, end_date, workers)
     messages = [f"{chunk[0].isoformat()}Z|{chunk[1].isoformat()}Z|{mode}|{region}|{resolution}" for chunk in date_chunks]
+    if max_cloud is not None:
+        messages = [f"{message}|{max_cloud}" for message in messages]
+    if band_set != "Raw":
+        messages = [f"{message}|{band_set}" for message in messages]
     
     return messages
 
@@ -57,7 +61,9 @@ if __name__ == "__main__":
     parser.add_argument("workers", type=int, help="Number of workers")
     parser.add_argument("mode", type=str, help="Processing mode")
     parser.add_argument("region", type=str, help="Region name")
-    parser.add_argument("resolution", type=int, help="Resolution value")
+    parser.add_argument("resolution", type=str, help="Resolution in pixels, like 1024, or meters per pixel sized to each polygon, like 10m")
+    parser.add_argument("--max_cloud", type=float, default=None, help="Skip scenes with a cloud cover above this percentage")
+    parser.add_argument("--band_set", choices=["Raw", "Ndvi"], default="Raw", help="Raw downloads Red, NIR and mask, Ndvi downloads NDVI computed by the API and mask")
     
     args = parser.parse_args()
     
@@ -72,5 +78,13 @@ if __name__ == "__main__":
         print("Error: Number of workers must be at least 1.")
         sys.exit(1)
     
-    messages = distribute_tasks(start_date, end_date, args.workers, args.mode, args.region, args.resolution)
+    if not re.match(r"^(\d{3,4}|(?!0+(\.0+)?m)\d{1,3}(\.\d+)?m)$", args.resolution):
+        print("Error: Resolution must be 100 to 9999 pixels or meters per pixel above 0 like 10m.")
+        sys.exit(1)
+
+    if args.max_cloud is not None and not 0 <= args.max_cloud <= 100:
+        print("Error: Max cloud cover must be between 0 and 100.")
+        sys.exit(1)
+
+    messages = distribute_tasks(start_date, end_date, args.workers, args.mode, args.region, args.resolution, args.max_cloud, args.band_set)
     send_messages(messages)
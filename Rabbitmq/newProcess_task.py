@@ -25,9 +25,9 @@ def split_date_range(start_date, end_date, workers, max_days=10):
 
     return final_chunks
 
-def distribute_tasks(start_date, end_date,CropId,SaveTiff, workers):
+def distribute_tasks(start_date, end_date,CropId,SaveTiff, workers, StatsMode="Tile"):
     chunks = split_date_range(start_date, end_date, workers)
-    messages = [f"{chunk[0].strftime('%Y-%m-%d')}|{chunk[1].strftime('%Y-%m-%d')}|{CropId}|{SaveTiff}" for chunk in chunks]
+    messages = [f"{chunk[0].strftime('%Y-%m-%d')}|{chunk[1].strftime('%Y-%m-%d')}|{CropId}|{SaveTiff}|{StatsMode}" for chunk in chunks]
     return messages
 
 def send_messages(messages):
@@ -53,6 +53,7 @@ if __name__ == "__main__":
     parser.add_argument("workers", type=int, help="Number of workers")
     parser.add_argument("CropId",type=int, help="The cropid you want to process")
     parser.add_argument("SaveTiff",choices=["True","False"], help="If you want save the tiff")
+    parser.add_argument("--stats_mode", choices=["Tile", "Field"], default="Tile", help="Tile reads every tile once for all its fields, Field masks the tiles once per field")
 
     args = parser.parse_args()
 
@@ -69,5 +70,5 @@ if __name__ == "__main__":
         print("Error: Workers must be at least 1.")
         sys.exit(1)
 
-    messages = distribute_tasks(start_date, end_date, cropid,saveTiff, args.workers)
+    messages = distribute_tasks(start_date, end_date, cropid,saveTiff, args.workers, args.stats_mode)
     send_messages(messages)